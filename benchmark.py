@@ -0,0 +1,252 @@
+"""
+This file times the matching variants on synthetic data (see synthetic.py), so
+that changes to the speed of the matching can be measured without the PUF or
+the SCF. For each PUF size, a synthetic PUF and SCF are generated and every
+requested variant is run, and the timings are saved as JSON. For example,
+    python benchmark.py --sizes 10000 50000 150000 --out bench.json
+times all 10 matching programs at three sizes. The SCF has one household for
+every scf_ratio PUF records, each with 5 implicates.
+
+With --check, the matchings are instead checked on the first size only, as
+in
+    python benchmark.py --check --sizes 2000
+which compares
+ - the sort matching (0A) with rankmatch.RankMatchLegacy, and the minimum
+   distance matching (1A, 1C and 1D) with each exact search engine with
+   LegacyNearest, the loops of the original programs
+ - the seeded random tie-breaking (2B and 2D) in parallel workers and in
+   small blocks with a serial run, as the draws of each stratum must not
+   depend on how the work is split
+ - the k-nearest and caliper matching (4A, 4D, 5C and 5D) with the brute
+   force engine with the index engine
+and reports the differences found by rankmatch.CompareMatches.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+import pandas as pd
+import match
+from rankmatch import RankMatchLegacy, CompareMatches
+from synthetic import SyntheticPUF, SyntheticSCF
+
+VARIANTS = ['0A', '0B', '1A', '1B', '1C', '1D', '2A', '2B', '2C', '2D']
+
+# Variants compared with the loops of the original programs, and the exact
+# engines they are run with
+CHECK_VARIANTS = ['0A', '1A', '1C', '1D']
+CHECK_ENGINES = ['index', 'brute']
+
+# Seeded random variants compared with a serial run, and the ways the work is
+# split for them, as (workers, block_rows)
+CHECK_SEEDED = ['2B', '2D']
+CHECK_SPLITS = [(4, match.BLOCK_ROWS), (1, 777)]
+
+# Variants compared between the exact engines
+CHECK_ENGINE_VARIANTS = ['4A', '4D', '5C', '5D']
+
+
+def TimeVariant(data, variant, repeat=1, **kwargs):
+    """
+    Runs a variant repeat times, each time on fresh copies of the shared
+    data so that cached indexes are rebuilt. Returns the fastest time in
+    seconds and the number of matchings.
+    """
+    times = list()
+    for r in range(repeat):
+        fresh = match.MatchData(data.puf, data.scf)
+        start = time.perf_counter()
+        rows = 0
+        for piece in match.IterVariant(fresh, variant, **kwargs):
+            rows += len(piece[0])
+        times.append(time.perf_counter() - start)
+    return min(times), rows
+
+
+def RunBenchmarks(sizes, variants=VARIANTS, scf_ratio=5, repeat=1, seed=0,
+                  **kwargs):
+    """
+    Times each variant for each PUF size. Extra keyword arguments are passed
+    to match.IterVariant. Returns a list of results, one per size and
+    variant.
+    """
+    results = list()
+    for size in sizes:
+        households = max(1, size // scf_ratio)
+        puf = match.AddIncomeMeasures(SyntheticPUF(size, seed))
+        scf = SyntheticSCF(households, seed)
+        data = match.MatchData(puf, scf)
+        for spec in variants:
+            variant = match.ParseVariant(spec)
+            seconds, rows = TimeVariant(data, variant, repeat, **kwargs)
+            results.append({'variant': spec, 'strategy': variant.strategy,
+                            'features': variant.features,
+                            'strata': variant.strata,
+                            'puf_records': size, 'scf_records': len(scf),
+                            'seconds': seconds, 'matches': rows})
+            print('{:>8} {:>10} {:>10.3f}s {:>10} matches'.format(
+                spec, size, seconds, rows))
+    return results
+
+
+def LegacyNearest(puf, scf, features):
+    """
+    The record-by-record loop of the original minimum distance programs
+    without strata (1A, 1C and 1D): each PUF record is matched to all of the
+    SCF records at the minimum distance, with its weight split by their
+    weights. This is kept as a reference for the search engines in
+    nearest.py.
+    """
+    names = match.FEATURES[features]
+    xa = np.column_stack([np.array(puf[match.PUF_NAMES.get(name, name)])
+                          for name in names])
+    xb = np.column_stack([np.array(scf[name]) for name in names])
+    wgt = np.array(scf['wgt'])
+    variances = np.array([np.average((col - np.average(col, weights=wgt))**2,
+                                     weights=wgt) for col in xb.T])
+    recid = np.array(puf['RECID'])
+    awt_all = np.array(puf['s006'])
+    y1 = np.array(scf['Y1'])
+    puf_list = list()
+    scf_list = list()
+    wt_list = list()
+    for i in range(len(xa)):
+        # A single variable is matched on the unscaled difference
+        if len(names) == 1:
+            dist = np.abs(xb[:, 0] - xa[i, 0])
+        else:
+            dist = np.sqrt(np.sum((xb - xa[i])**2 / variances, axis=1))
+        matched = np.flatnonzero(dist == np.min(dist))
+        mwgts = wgt[matched]
+        for j in range(len(matched)):
+            puf_list.append(recid[i])
+            scf_list.append(y1[matched[j]])
+            wt_list.append(awt_all[i] * mwgts[j] / sum(mwgts))
+    return pd.DataFrame({'pufseq': puf_list, 'scf_seq': scf_list,
+                         'wgt': wt_list})
+
+
+def _Check(results, check, spec, setting, new, old, size):
+    """
+    Adds the comparison of the matchings new with old to results.
+    """
+    res = CompareMatches(new, old)
+    res.update({'check': check, 'variant': spec, 'setting': setting,
+                'puf_records': size})
+    results.append(res)
+    print('{:>9} {:>4} {:>20} {:>8} pairs differing, {:.4f} weight '
+          'moved'.format(check, spec, setting, res['pairs_differing'],
+                         res['wgt_moved']))
+
+
+def CheckVariants(size, variants=CHECK_VARIANTS, engines=CHECK_ENGINES,
+                  seeded=CHECK_SEEDED, splits=CHECK_SPLITS,
+                  engine_variants=CHECK_ENGINE_VARIANTS, scf_ratio=5,
+                  seed=0):
+    """
+    On a synthetic PUF of size records, compares the matchings of each of
+    variants, run with each engine, with those of the loop of the original
+    program; those of each of seeded, with random tie-breaking seeded by
+    seed, split as in each of splits with those of a serial run; and those
+    of each of engine_variants with the first engine with those with the
+    others. Returns a list of results, one per comparison, holding the
+    summary of CompareMatches.
+    """
+    puf = match.AddIncomeMeasures(SyntheticPUF(size, seed))
+    scf = SyntheticSCF(max(1, size // scf_ratio), seed)
+    data = match.MatchData(puf, scf)
+    results = list()
+    for spec in variants:
+        variant = match.ParseVariant(spec)
+        if variant.strata is not None or variant.strategy not in ['sort',
+                                                                  'split']:
+            raise ValueError('no original loop to compare with ' + spec)
+        if variant.strategy == 'sort':
+            varname = match.FEATURES[variant.features][0]
+            old = RankMatchLegacy(puf, scf, varname)
+            spec_engines = ['index']
+        else:
+            old = LegacyNearest(puf, scf, variant.features)
+            spec_engines = engines
+        for engine in spec_engines:
+            new = match.RunVariant(data, variant, engine=engine)
+            _Check(results, 'original', spec, engine, new, old, size)
+    for spec in seeded:
+        variant = match.ParseVariant(spec)
+        old = match.RunVariant(data, variant, seed=seed)
+        for workers, block_rows in splits:
+            pieces = list(match.IterVariant(data, variant, workers,
+                                            block_rows=block_rows,
+                                            seed=seed))
+            new = pd.DataFrame({
+                name: np.concatenate([piece[k] for piece in pieces])
+                for k, name in enumerate(['pufseq', 'scf_seq', 'wgt'])})
+            _Check(results, 'split', spec,
+                   'workers={} rows={}'.format(workers, block_rows), new,
+                   old, size)
+    for spec in engine_variants:
+        variant = match.ParseVariant(spec)
+        old = match.RunVariant(data, variant, engine=engines[0])
+        for engine in engines[1:]:
+            new = match.RunVariant(data, variant, engine=engine)
+            _Check(results, 'engine', spec, engine + ' v ' + engines[0],
+                   new, old, size)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the matching variants on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 50000],
+                        help='numbers of PUF records')
+    parser.add_argument('--variants', nargs='+', default=VARIANTS,
+                        help='variants to time (default: all programs)')
+    parser.add_argument('--scf-ratio', type=int, default=5,
+                        help='PUF records per SCF household (default: 5)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of each variant; the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the synthetic data')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes for matching strata in parallel')
+    parser.add_argument('--engine', choices=match.ENGINES, default='index',
+                        help='search engine for minimum distance matching')
+    parser.add_argument('--implicates', action='store_true',
+                        help='match against each SCF implicate separately')
+    parser.add_argument('--out', default='benchmark_results.json',
+                        help='file for the results (JSON)')
+    parser.add_argument('--check', action='store_true',
+                        help='check the matchings against the loops of '
+                             'the original programs, across ways of '
+                             'splitting the work and across engines, on the '
+                             'first size, instead of timing them')
+    args = parser.parse_args(argv)
+    if args.check:
+        results = CheckVariants(args.sizes[0], scf_ratio=args.scf_ratio,
+                                seed=args.seed)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        if any(res['pairs_differing'] for res in results):
+            sys.exit('matchings differ; see ' + args.out)
+        return
+    results = RunBenchmarks(args.sizes, args.variants, args.scf_ratio,
+                            args.repeat, args.seed, workers=args.workers,
+                            engine=args.engine, implicates=args.implicates)
+    report = {'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.machine(),
+              'cpus': os.cpu_count(),
+              'workers': args.workers,
+              'engine': args.engine,
+              'implicates': args.implicates,
+              'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
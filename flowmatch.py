@@ -0,0 +1,125 @@
+"""
+This file holds the weight-constrained minimum distance matching (the 3x
+programs). The unconstrained programs (1x and 2x) match each PUF record to its
+nearest SCF records whatever the SCF weights, so some SCF households are used
+far beyond their weight and others not at all. Here, as in the matching by
+sorting on income, the matchings use up both the PUF weights (s006) and the
+SCF weights rescaled to the PUF total (wgt2), while keeping the total distance
+of the matchings as small as possible.
+
+This is a transportation problem. Each PUF record is only allowed to match to
+its k nearest SCF records, plus the nearest PUF record to each SCF record is
+allowed to match to it, so every SCF record can be reached. These candidate
+pairs make the problem sparse: it has about k variables per PUF record rather
+than one per pair of records. It is solved as a linear program with the HiGHS
+solver in scipy.
+
+The candidate pairs alone may not be able to use up every weight, so each
+record may also send weight through an expensive fallback, at a cost larger
+than any candidate distance. Whatever weight goes through the fallback, which
+is usually none, is matched by sorting on the scaled matching variables, as in
+RankMatchArrays. The totals are then kept exactly.
+"""
+import numpy as np
+from rankmatch import RankMatchArrays
+
+# Number of nearest SCF records considered for each PUF record
+CANDIDATES = 10
+
+# Matchings with weights of TINY or less are dropped
+TINY = 1e-6
+
+# HiGHS method used by scipy.optimize.linprog
+METHOD = 'highs-ds'
+
+
+def CandidatePairs(xa, xb, scale, k=CANDIDATES):
+    """
+    Finds the candidate pairs for the PUF points xa and the SCF points xb,
+    with each variable divided by the square root of scale: the k nearest SCF
+    points to each PUF point and the nearest PUF point to each SCF point.
+    Returns the PUF position, SCF position and scaled distance of each pair.
+    """
+    from scipy.spatial import cKDTree
+    sd = np.sqrt(np.asarray(scale, dtype=np.float64))
+    sd = np.where(sd > 0, sd, 1.)
+    qa = np.asarray(xa, dtype=np.float64) / sd
+    qb = np.asarray(xb, dtype=np.float64) / sd
+    k = min(k, len(qb))
+    dist, cols = cKDTree(qb).query(qa, k=k)
+    dist = dist.reshape(len(qa), k)
+    cols = cols.reshape(len(qa), k)
+    rows = np.repeat(np.arange(len(qa)), k)
+    # Make sure every SCF point has a candidate
+    rdist, rrows = cKDTree(qa).query(qb, k=1)
+    rows = np.concatenate((rows, rrows))
+    cols = np.concatenate((cols.reshape(-1), np.arange(len(qb))))
+    dist = np.concatenate((dist.reshape(-1), rdist))
+    # Drop duplicate pairs
+    _, first = np.unique(rows * len(qb) + cols, return_index=True)
+    return rows[first], cols[first], dist[first]
+
+
+def FlowMatchArrays(xa, awt, xb, bwt, scale, k=CANDIDATES):
+    """
+    Matches the PUF points xa with weights awt to the SCF points xb with
+    weights bwt, using up all of the weights on both sides, so that the total
+    scaled distance of the matchings is as small as possible among the
+    candidate pairs (see CandidatePairs). The SCF weights are first rescaled
+    to the PUF total. Returns the PUF position, SCF position and weight of
+    each matching.
+    """
+    from scipy.optimize import linprog
+    from scipy.sparse import coo_matrix
+    awt = np.asarray(awt, dtype=np.float64)
+    bwt = np.asarray(bwt, dtype=np.float64)
+    bwt = bwt * (np.sum(awt) / np.sum(bwt))
+    na = len(awt)
+    nb = len(bwt)
+    rows, cols, dist = CandidatePairs(xa, xb, scale, k)
+    npairs = len(rows)
+    # Variables: one per candidate pair, then the fallback weight of each PUF
+    # record and of each SCF record
+    penalty = 2. * dist.max() + 1.
+    cost = np.concatenate((dist, np.full(na + nb, penalty)))
+    # The equations are the weight of each PUF record, the weight of each SCF
+    # record, and the balance of the weights sent through the fallback
+    fall = npairs + np.arange(na + nb)
+    eq_rows = np.concatenate((rows, na + cols, np.arange(na + nb),
+                              np.full(na + nb, na + nb)))
+    eq_cols = np.concatenate((np.arange(npairs), np.arange(npairs), fall,
+                              fall))
+    values = np.concatenate((np.ones(2 * npairs + na + nb), np.ones(na),
+                             -np.ones(nb)))
+    # One equation is implied by the others, so the last SCF equation is
+    # left out
+    keep = eq_rows != na + nb - 1
+    eq_rows = np.where(eq_rows == na + nb, na + nb - 1, eq_rows)
+    a_eq = coo_matrix((values[keep], (eq_rows[keep], eq_cols[keep])),
+                      shape=(na + nb, npairs + na + nb)).tocsr()
+    b_eq = np.concatenate((awt, bwt[:-1], [0.]))
+    res = linprog(cost, A_eq=a_eq, b_eq=b_eq, bounds=(0, None),
+                  method=METHOD)
+    if res.status != 0:
+        raise RuntimeError('constrained matching failed: ' + res.message)
+    flow = res.x[:npairs]
+    used = flow > TINY
+    i = rows[used]
+    j = cols[used]
+    wt = flow[used]
+    # Match any weight sent through the fallback by sorting
+    afall = res.x[npairs:npairs + na]
+    bfall = np.maximum(bwt - np.bincount(cols, weights=flow, minlength=nb),
+                       0.)
+    if afall.sum() > TINY * na:
+        sd = np.sqrt(np.where(np.asarray(scale) > 0, scale, 1.))
+        ra = np.flatnonzero(afall > TINY)
+        rb = np.flatnonzero(bfall > TINY)
+        fi, fj, fwt = RankMatchArrays((xa[ra] / sd).sum(axis=1), afall[ra],
+                                      (xb[rb] / sd).sum(axis=1), bfall[rb],
+                                      TINY)
+        i = np.concatenate((i, ra[fi]))
+        j = np.concatenate((j, rb[fj]))
+        wt = np.concatenate((wt, fwt))
+    order = np.lexsort((j, i))
+    return i[order], j[order], wt[order]
@@ -0,0 +1,1139 @@
+"""
+This file runs the matching between the PUF and the SCF. Each matching program
+described in the README is a variant made up of three parts:
+    strategy:     sort (0), split (1), random (2), flow (3), knn (4) or
+                  caliper (5)
+    features:     the matching variables, one of
+                      income             comparable income (A and B)
+                      age_income         age and comparable income (C)
+                      age_active_passive age, active and passive income (D)
+    stratification: none, or the strata to match within: age groups (B),
+                  married (marital status) or a cross-product such as
+                  age*married
+A variant can be given by its program code, e.g. 1C, or spelled out as
+strategy:features[:strata], e.g. split:age_active_passive:age.
+
+Several variants can be run in one call. The PUF and SCF are loaded once, and
+the arrays, income measures and search indexes are shared between variants.
+For example,
+    python match.py 0A 1A 1C 2D
+runs four variants and saves the results for each as match_<name>_results.bin
+in the binary format described in output.py, which can be loaded with
+output.LoadMatches. The results can also be written as CSV with --format.
+With --pipeline, the PUF is loaded and aged in a background process while the
+SCF side of every variant is prepared (LoadDataPipelined).
+
+The SCF uses multiple imputation, so each household appears once in each of
+its 5 implicates. By default the matching ignores this; with --implicates,
+the PUF is matched separately against each implicate, the last digit of Y1,
+and the results are stacked with an implicate column. With --replicates, the
+weights of the matchings are also recomputed under each SCF replicate weight,
+for estimating the variance of results (see nearest.SplitReplicates).
+"""
+import argparse
+import collections
+import concurrent.futures
+import os
+import sys
+import numpy as np
+import pandas as pd
+from nearest import NearestIndex, BlockedIndex, CompressedIndex
+from nearest import MatchNearestArrays, MatchKernelArrays, MatchCaliperArrays
+from nearest import NEIGHBOURS, KERNEL, KERNELS, MAX_MATCHES
+from nearest import SplitReplicates
+from nearest import GridIndex, ApproxError
+from rankmatch import RankMatchArrays
+from flowmatch import FlowMatchArrays, CANDIDATES
+from moments import Moments
+from puf_cache import LoadPUFYears, CacheKey, FileHash, ReadExtract, RECVARS
+from parallel import MapShared
+from output import MatchWriter, BinaryMatchWriter, UNMATCHED_COLUMNS
+from output import ReplicateWriter
+from profiling import RunReport
+from rematch import ResultCache, Fingerprint, ContentBlocks
+from scf_prep import LoadReplicates, AlignReplicates
+from strata import Bins, Categories, Stratification, Group
+
+CUR_PATH = os.path.abspath(os.path.dirname(__file__))
+
+STRATEGIES = {'0': 'sort', '1': 'split', '2': 'random', '3': 'flow',
+              '4': 'knn', '5': 'caliper'}
+
+# Matching variables in the SCF; the PUF equivalents are given in PUF_NAMES
+FEATURES = {'income': ['compincome'],
+            'age_income': ['age', 'compincome'],
+            'age_active_passive': ['age', 'activeincome', 'passiveincome']}
+PUF_NAMES = {'age': 'age_head', 'married': 'MARS'}
+
+# Every SCF matching variable, for which the weighted moments are computed
+MOMENT_VARS = ['age', 'compincome', 'activeincome', 'passiveincome']
+
+# Distances for minimum distance matching: each variable scaled by its
+# variance, or the Mahalanobis distance using the full covariance matrix
+METRICS = ['scaled', 'mahalanobis']
+
+CODES = {'A': ('income', None),
+         'B': ('income', 'age'),
+         'C': ('age_income', None),
+         'D': ('age_active_passive', None)}
+
+# Age groups: under 35, 35-44, 45-54, 55-64, 65-74 and 75 plus
+AGE_BINS = [35, 45, 55, 65, 75]
+
+# Dimensions of the strata, which can be crossed as in age*married. Marital
+# status is the PUF filing status (MARS) 2 or 3, for married filing jointly or
+# separately, and the SCF married 1, for married or living with a partner
+DIMENSIONS = {'age': Bins('age', AGE_BINS),
+              'married': Categories('married', {'puf': [[1, 4, 5], [2, 3]],
+                                                'scf': [[2], [1]]})}
+
+# The SCF multiple imputation gives 5 implicates of each household
+IMPLICATES = [1, 2, 3, 4, 5]
+
+# Search engines for minimum distance matching, the default memory limit in
+# bytes for the brute-force engine and the default error bound, in standard
+# deviations of the matching variables, for the approximate grid engine
+ENGINES = ['index', 'brute', 'grid']
+MEM_BUDGET = 2**30
+TOLERANCE = 0.05
+
+# Default caliper, the largest distance in standard deviations of the matching
+# variables at which caliper matching (5x) matches records
+CALIPER = 0.2
+
+# Strategies whose matchings do not depend on the SCF weights, so they can be
+# reweighted with the SCF replicate weights
+REPLICATE_STRATEGIES = ['split', 'knn', 'caliper']
+
+# Number of PUF records used to compare the grid engine with the exact search
+CHECK_RECORDS = 10000
+
+# Number of PUF records matched at a time when the results are streamed
+BLOCK_ROWS = 2**16
+
+Variant = collections.namedtuple('Variant',
+                                 ['name', 'strategy', 'features', 'strata'])
+
+
+def ParseVariant(spec):
+    """
+    Converts a variant specification, either a program code such as 1C or
+    strategy:features[:strata], into a Variant.
+    """
+    if len(spec) == 2 and spec[0] in STRATEGIES and spec[1] in CODES:
+        features, strata = CODES[spec[1]]
+        return Variant(spec, STRATEGIES[spec[0]], features, strata)
+    parts = spec.split(':')
+    if len(parts) not in [2, 3]:
+        raise ValueError('invalid variant: ' + spec)
+    strategy, features = parts[:2]
+    strata = parts[2] if len(parts) == 3 and parts[2] != 'none' else None
+    if strategy not in STRATEGIES.values():
+        raise ValueError('unknown strategy: ' + strategy)
+    if features not in FEATURES:
+        raise ValueError('unknown features: ' + features)
+    if strata is not None and not all(name in DIMENSIONS
+                                      for name in strata.split('*')):
+        raise ValueError('unknown stratification: ' + strata)
+    if strategy == 'sort' and len(FEATURES[features]) > 1:
+        raise ValueError('sort matching uses a single variable')
+    # Names are used in file names, so the crossed strata are joined by -
+    return Variant('_'.join(parts).replace('*', '-'), strategy, features,
+                   strata)
+
+
+def CheckVariant(variant, engine, replicates=False):
+    """
+    Raises a ValueError if variant cannot be run with the search engine, or
+    with replicate weights if replicates.
+    """
+    if variant.strategy in ['knn', 'caliper'] and engine == 'grid':
+        raise ValueError(variant.strategy + ' matching needs an exact engine')
+    if replicates and variant.strategy not in REPLICATE_STRATEGIES:
+        raise ValueError('replicate weights are not supported for ' +
+                         variant.strategy + ' matching')
+
+
+def AddIncomeMeasures(puf):
+    """
+    Calculates the comparable, active and passive income measures for the
+    PUF.
+    """
+    puf['activeincome'] = (puf['e00200'] + puf['e00900'] + puf['e02100'] +
+                           puf['e02000'])
+    puf['passiveincome'] = (puf['e00400'] + puf['e00300'] + puf['e00600'] +
+                            puf['e02300'] + puf['e01500'] + puf['e02400'])
+    puf['compincome'] = (puf['e00200'] + puf['e02100'] + puf['e00900'] +
+                         puf['e02000'] + puf['e00400'] + puf['e00300'] +
+                         puf['e00600'] + puf['e02300'] + puf['e01500'] +
+                         puf['e02400'])
+    return puf
+
+
+def Implicate(y1):
+    """
+    Returns the implicate number (1 to 5) of each SCF record, which is the
+    last digit of Y1.
+    """
+    return np.asarray(y1) % 10
+
+
+class MatchData(object):
+    """
+    Holds the PUF and SCF data shared by all matching variants, along with the
+    arrays, strata, SCF moments and search indexes derived from them.
+    """
+
+    def __init__(self, puf, scf):
+        self.puf = puf
+        self.scf = scf
+        self._arrays = dict()
+        # Strata and sorted arrays, kept by side so the SCF ones can be
+        # shared (see with_puf)
+        self._groupings = {'puf': dict(), 'scf': dict()}
+        self._sorted = {'puf': dict(), 'scf': dict()}
+        self._moments = dict()
+        self._indexes = dict()
+        # Hashes identifying the inputs, saved with binary results
+        self.hashes = dict()
+
+    def array(self, side, varname):
+        """
+        Returns a variable from the PUF (side='puf') or SCF (side='scf') as an
+        array. SCF variable names are translated for the PUF.
+        """
+        key = (side, varname)
+        if key not in self._arrays:
+            if side == 'puf':
+                data = self.puf[PUF_NAMES.get(varname, varname)]
+            else:
+                data = self.scf[varname]
+            self._arrays[key] = np.array(data)
+        return self._arrays[key]
+
+    def matrix(self, side, features, rows=None):
+        """
+        Returns the matching variables for features as a 2-D array.
+        """
+        cols = [self.array(side, varname) for varname in FEATURES[features]]
+        xmat = np.column_stack(cols)
+        if rows is not None:
+            xmat = xmat[rows]
+        return xmat
+
+    def grouping(self, side, strata, implicates=False):
+        """
+        Returns (keys, order, offsets) for the strata of one side, from
+        strata.Group: the records of the stratum keys[g] are
+        order[offsets[g]:offsets[g + 1]]. With implicates, the SCF strata are
+        further divided by implicate, with keys (stratum, implicate).
+        """
+        groupings = self._groupings[side]
+        if (strata, implicates) not in groupings:
+            nrows = len(self.puf if side == 'puf' else self.scf)
+            if strata is None:
+                keys, codes = [None], np.zeros(nrows, dtype=np.int64)
+            else:
+                strat = Stratification([DIMENSIONS[name]
+                                        for name in strata.split('*')])
+                keys = strat.keys()
+                codes = strat.codes(side, [self.array(side, dim.varname)
+                                           for dim in strat.dimensions])
+            if implicates:
+                imp = Implicate(self.array('scf', 'Y1'))
+                if np.any((imp < IMPLICATES[0]) | (imp > IMPLICATES[-1])):
+                    raise ValueError('SCF records with an unknown implicate')
+                codes = codes * len(IMPLICATES) + (imp - IMPLICATES[0])
+                keys = [(key, m) for key in keys for m in IMPLICATES]
+            order, offsets = Group(codes, len(keys))
+            groupings[strata, implicates] = (keys, order, offsets)
+        return groupings[strata, implicates]
+
+    def scf_strata(self, strata, implicates=False):
+        """
+        Returns a list of (key, scf_rows) for each stratum of the SCF, divided
+        by implicate with implicates (see strata). It uses only the SCF.
+        """
+        keys, order, offsets = self.grouping('scf', strata, implicates)
+        return [(key, order[offsets[g]:offsets[g + 1]])
+                for g, key in enumerate(keys)]
+
+    def stratum_slices(self, strata, implicates=False):
+        """
+        Returns a list of (key, puf_slice, scf_slice) for each stratum, giving
+        the records of the stratum within the arrays returned by sorted.
+        """
+        pkeys, porder, poffsets = self.grouping('puf', strata)
+        skeys, sorder, soffsets = self.grouping('scf', strata, implicates)
+        nimp = len(IMPLICATES) if implicates else 1
+        return [(key, slice(poffsets[g // nimp], poffsets[g // nimp + 1]),
+                 slice(soffsets[g], soffsets[g + 1]))
+                for g, key in enumerate(skeys)]
+
+    def strata(self, strata, implicates=False):
+        """
+        Returns a list of (key, puf_rows, scf_rows) for each stratum. With
+        implicates, each stratum is further divided by SCF implicate, with
+        every PUF record in the stratum matched against each implicate; the
+        key is then (stratum, implicate).
+        """
+        porder = self.grouping('puf', strata)[1]
+        sorder = self.grouping('scf', strata, implicates)[1]
+        return [(key, porder[pslc], sorder[sslc])
+                for key, pslc, sslc in self.stratum_slices(strata,
+                                                           implicates)]
+
+    def sorted(self, side, varname, strata, implicates=False):
+        """
+        Returns a variable with the records put in the order of the strata
+        (see grouping), so that the values for each stratum are a contiguous
+        slice, given by stratum_slices.
+        """
+        arrays = self._sorted[side]
+        if (varname, strata, implicates) not in arrays:
+            order = self.grouping(side, strata, implicates)[1]
+            arrays[varname, strata, implicates] = \
+                self.array(side, varname)[order]
+        return arrays[varname, strata, implicates]
+
+    def sorted_matrix(self, side, features, strata, implicates=False):
+        """
+        Returns the matching variables for features as a 2-D array, with the
+        records in the order of the strata (see sorted).
+        """
+        return np.column_stack([self.sorted(side, varname, strata,
+                                            implicates)
+                                for varname in FEATURES[features]])
+
+    def moments(self, strata, key, scf_rows):
+        """
+        Returns the weighted Moments of the SCF variables in MOMENT_VARS over
+        the records in a stratum, computing them on first use.
+        """
+        mkey = (strata, key)
+        if mkey not in self._moments:
+            x = np.column_stack([self.array('scf', varname)[scf_rows]
+                                 for varname in MOMENT_VARS])
+            self._moments[mkey] = Moments(x,
+                                          self.array('scf', 'wgt')[scf_rows],
+                                          MOMENT_VARS)
+        return self._moments[mkey]
+
+    def scaling(self, features, strata, key, scf_rows, metric='scaled'):
+        """
+        Returns (whiten, scale) for the distance between records in a
+        stratum. The matching variables are multiplied by the matrix whiten,
+        unless it is None, and then scaled by scale. For the Mahalanobis
+        metric with several variables, whiten is the inverse of the Cholesky
+        factor of the covariance matrix and scale is 1; otherwise scale is
+        the variance of each variable.
+        """
+        assert metric in METRICS
+        names = FEATURES[features]
+        moments = self.moments(strata, key, scf_rows)
+        if metric == 'mahalanobis' and len(names) > 1:
+            return moments.whitening(names), np.ones(len(names))
+        return None, moments.variances(names)
+
+    def index(self, features, strata, key, scf_rows, engine='index',
+              mem_budget=MEM_BUDGET, tolerance=TOLERANCE, metric='scaled'):
+        """
+        Returns the search index over the SCF records in a stratum, building
+        it on first use.
+        """
+        ikey = (features, strata, key, engine, mem_budget, tolerance, metric)
+        if ikey not in self._indexes:
+            xb = self.matrix('scf', features, scf_rows)
+            mwgt = self.array('scf', 'wgt')[scf_rows]
+            whiten, scale = self.scaling(features, strata, key, scf_rows,
+                                         metric)
+            if whiten is not None:
+                xb = xb.dot(whiten.T)
+            self._indexes[ikey] = BuildIndex(xb, mwgt, engine, mem_budget,
+                                             tolerance, scale)
+        return self._indexes[ikey]
+
+    def with_puf(self, puf):
+        """
+        Returns MatchData for another PUF, such as the PUF aged to another
+        year, that shares the SCF arrays, strata, moments and search indexes,
+        so they are only built once for all of them.
+        """
+        data = MatchData(puf, self.scf)
+        data._arrays.update((key, arr) for key, arr in self._arrays.items()
+                            if key[0] == 'scf')
+        data._groupings['scf'] = self._groupings['scf']
+        data._sorted['scf'] = self._sorted['scf']
+        data._moments = self._moments
+        data._indexes = self._indexes
+        return data
+
+    def prepare(self, variant, implicates=False, engine='index',
+                mem_budget=MEM_BUDGET, tolerance=TOLERANCE, metric='scaled',
+                indexes=True):
+        """
+        Does the work on the SCF side of a variant ahead of the matching: the
+        strata, the moments of each stratum and, with indexes, the search
+        index of each stratum for minimum distance matching. It uses only the
+        SCF, so it can run before the PUF is loaded.
+        """
+        for key, scf_rows in self.scf_strata(variant.strata, implicates):
+            if len(scf_rows) == 0:
+                continue
+            self.scaling(variant.features, variant.strata, key, scf_rows,
+                         metric)
+            if indexes and variant.strategy in ['split', 'random', 'knn',
+                                                'caliper']:
+                self.index(variant.features, variant.strata, key, scf_rows,
+                           engine, mem_budget, tolerance, metric)
+
+
+def Scale(xb, mwgt):
+    """
+    Returns the weighted variance of each column of xb, used to scale the
+    matching variables.
+    """
+    return Moments(xb, mwgt).variances()
+
+
+def BuildIndex(xb, mwgt, engine='index', mem_budget=MEM_BUDGET,
+               tolerance=TOLERANCE, scale=None):
+    """
+    Builds the search over the SCF points xb. With several matching
+    variables, each is scaled by its weighted variance. The engine is index,
+    for the sorted values or KD-tree in NearestIndex, brute, for the blocked
+    brute-force search in BlockedIndex limited to mem_budget bytes, or grid,
+    for the approximate search in GridIndex, which matches each PUF record to
+    SCF records at most tolerance standard deviations further away than the
+    nearest. The variances can be passed in as scale. SCF records with
+    identical values are collapsed first, so the search runs over the unique
+    points.
+    """
+    assert engine in ENGINES
+    if xb.shape[1] == 1 and engine != 'grid':
+        # A single variable is matched on its unscaled distance
+        scale = None
+    elif scale is None:
+        scale = Scale(xb, mwgt)
+    if engine == 'brute':
+        def make_index(points, weights):
+            return BlockedIndex(points, scale, mem_budget)
+    elif engine == 'grid':
+        def make_index(points, weights):
+            return GridIndex(points, scale, tolerance, weights)
+    else:
+        def make_index(points, weights):
+            return NearestIndex(points, scale)
+    return CompressedIndex(xb, mwgt, make_index, mem_budget)
+
+
+def StratumRNG(seed, key):
+    """
+    Returns the random number generator for the random tie-breaking in one
+    stratum. It depends only on seed and the stratum key, so a seeded run
+    gives the same matchings however the strata are divided between workers
+    or the PUF records into blocks. With seed None, the generator is seeded
+    from the operating system.
+    """
+    if key is None:
+        key = ()
+    elif not isinstance(key, tuple):
+        key = (key,)
+    # Keys of crossed strata, (stratum, implicate), hold a tuple
+    key = sum([k if isinstance(k, tuple) else (k,) for k in key], ())
+    # The spawn key keeps the streams of different strata independent
+    spawn_key = tuple(0 if k is None else int(k) + 1 for k in key)
+    return np.random.default_rng(np.random.SeedSequence(seed,
+                                                        spawn_key=spawn_key))
+
+
+def MatchArrays(xa, awt, xb, mwgt, strategy, index=None, engine='index',
+                mem_budget=MEM_BUDGET, rng=None, tolerance=TOLERANCE,
+                candidates=CANDIDATES, scale=None, neighbours=NEIGHBOURS,
+                kernel=KERNEL, caliper=CALIPER, max_matches=MAX_MATCHES):
+    """
+    Matches the PUF points xa with weights awt to the SCF points xb with
+    weights mwgt. A prebuilt search over xb may be passed in as index;
+    otherwise one is built with BuildIndex. The variances used to scale the
+    variables can be passed in as scale. The random strategy selects ties with
+    the numpy Generator rng, the flow strategy considers the candidates nearest
+    SCF records for each PUF record, and the knn strategy splits the weight of
+    each PUF record across its neighbours nearest SCF records by kernel (see
+    MatchKernelArrays). The caliper strategy matches each PUF record to every
+    SCF record within caliper standard deviations, or the max_matches nearest
+    of them, leaving out the PUF records with none; the batches of its range
+    queries fit in mem_budget. Returns the PUF position, SCF position and
+    weight of each matching.
+    """
+    if strategy == 'sort':
+        return RankMatchArrays(xa[:, 0], awt, xb[:, 0], mwgt)
+    if scale is None:
+        scale = Scale(xb, mwgt)
+    if strategy == 'flow':
+        return FlowMatchArrays(xa, awt, xb, mwgt, scale, candidates)
+    if index is None:
+        index = BuildIndex(xb, mwgt, engine, mem_budget, tolerance, scale)
+    if strategy == 'knn':
+        return MatchKernelArrays(index, xa, awt, mwgt, neighbours, kernel)
+    if strategy == 'caliper':
+        radius = caliper
+        if xb.shape[1] == 1:
+            # A single variable is matched on its unscaled distance
+            radius = caliper * np.sqrt(scale[0])
+        return MatchCaliperArrays(index, xa, awt, mwgt, radius, max_matches,
+                                  mem_budget)
+    return MatchNearestArrays(index, xa, awt, mwgt, strategy, rng)
+
+
+def IterVariant(data, variant, workers=1, engine='index',
+                mem_budget=MEM_BUDGET, implicates=False,
+                block_rows=BLOCK_ROWS, report=None, seed=None,
+                tolerance=TOLERANCE, candidates=CANDIDATES, cache=None,
+                metric='scaled', neighbours=NEIGHBOURS, kernel=KERNEL,
+                caliper=CALIPER, unmatched=None, replicates=None,
+                max_matches=MAX_MATCHES):
+    """
+    Runs one matching variant, yielding the matchings in pieces as (pufseq,
+    scf_seq, wgt) arrays, plus the implicate when matching by implicate.
+    With workers greater than 1, the strata are matched in parallel in that
+    many processes. Otherwise, unconstrained minimum distance matching is
+    done at most block_rows PUF records at a time (in blocks cut by
+    rematch.ContentBlocks when cache is given). The engine, mem_budget and
+    tolerance are passed to BuildIndex, candidates to FlowMatchArrays,
+    neighbours and kernel to MatchKernelArrays, and caliper and max_matches
+    to MatchArrays.
+    For the caliper strategy, the PUF records of each piece left unmatched
+    are appended to the list unmatched, if given, as (pufseq, wgt) arrays,
+    plus the implicate when matching by implicate. If replicates, a matrix
+    of SCF replicate weights with a row for each SCF record, is given, each
+    piece ends with an iterator over the weights of its matchings under
+    each replicate, in chunks of matchings that fit in mem_budget (see
+    nearest.SplitReplicates); the matchings themselves are found once, from
+    the full-sample weights. The distance is given by metric (see
+    MatchData.scaling). With implicates, the PUF is matched separately
+    against each of the SCF implicates. For the random strategy, the ties
+    in each stratum are selected with the generator StratumRNG(seed, key).
+    The stages and the numbers of records, tied records (when splitting on
+    ties) and matchings are recorded in report, if given; the stages are
+    entered and left between pieces, so the time spent by the caller on
+    each piece is not included. If cache, a rematch.ResultCache, is given,
+    the matchings of each unit of a stratum and block of PUF records are
+    saved, and units whose inputs have not changed since an earlier run are
+    loaded instead of matched again; with several workers, a stratum with
+    any changed unit is matched whole.
+    """
+    report = report or RunReport()
+    CheckVariant(variant, engine, replicates is not None)
+    with report.stage('strata'):
+        # The records are put in the order of the strata once, so the arrays
+        # of each stratum are slices of them
+        pufx = data.sorted_matrix('puf', variant.features, variant.strata)
+        pufwt = data.sorted('puf', 's006', variant.strata)
+        scfx = data.sorted_matrix('scf', variant.features, variant.strata,
+                                  implicates)
+        scfwt = data.sorted('scf', 'wgt', variant.strata, implicates)
+        porder = data.grouping('puf', variant.strata)[1]
+        sorder = data.grouping('scf', variant.strata, implicates)[1]
+        strata = list()
+        slices = list()
+        for key, pslc, sslc in data.stratum_slices(variant.strata,
+                                                   implicates):
+            puf_rows, scf_rows = porder[pslc], sorder[sslc]
+            if len(puf_rows) == 0:
+                continue
+            if len(scf_rows) == 0:
+                raise ValueError('no SCF records in stratum ' + str(key))
+            strata.append((key, puf_rows, scf_rows))
+            slices.append((pslc, sslc))
+        # The PUF arrays are shared by all implicates of a stratum
+        puf_arrays = dict()
+        tasks = list()
+        scales = list()
+        for (key, puf_rows, scf_rows), (pslc, sslc) in zip(strata, slices):
+            pkey = key[0] if implicates else key
+            if pkey not in puf_arrays:
+                puf_arrays[pkey] = (pufx[pslc], pufwt[pslc])
+            xa, awt = puf_arrays[pkey]
+            xb = scfx[sslc]
+            whiten, scale = data.scaling(variant.features, variant.strata,
+                                         key, scf_rows, metric)
+            if whiten is not None:
+                xa = xa.dot(whiten.T)
+                xb = xb.dot(whiten.T)
+            tasks.append((xa, awt, xb, scfwt[sslc]))
+            scales.append(scale)
+        recid = data.array('puf', 'RECID')
+        s006 = data.array('puf', 's006')
+        scf_wgt = data.array('scf', 'wgt')
+        y1 = data.array('scf', 'Y1')
+    report.count('strata', len(strata))
+
+    def _Piece(key, puf_rows, scf_rows, i, j, wt):
+        # Convert positions within a stratum to record ids
+        report.count('puf_records', len(puf_rows))
+        report.count('rows', len(i))
+        if variant.strategy == 'split':
+            tied = np.bincount(i, minlength=len(puf_rows)) > 1
+            report.count('tied_records', np.count_nonzero(tied))
+        if variant.strategy == 'caliper':
+            lost = puf_rows[np.bincount(i, minlength=len(puf_rows)) == 0]
+            report.count('unmatched_records', len(lost))
+            if unmatched is not None:
+                extra = (recid[lost], s006[lost])
+                if implicates:
+                    extra += (np.full(len(lost), key[1]),)
+                unmatched.append(extra)
+        piece = (recid[puf_rows[i]], y1[scf_rows[j]], wt)
+        if implicates:
+            piece += (Implicate(piece[1]),)
+        if replicates is not None:
+            piece += (SplitReplicates(i, wt, scf_wgt[scf_rows[j]],
+                                      replicates, scf_rows[j], mem_budget),)
+        return piece
+
+    rngs = [None] * len(strata)
+    if variant.strategy == 'random':
+        rngs = [StratumRNG(seed, key) for key, puf_rows, scf_rows in strata]
+    # The matching is done in units of a stratum against a block of PUF
+    # records, or the whole stratum for the strategies that use up the
+    # weights of the stratum at once
+    whole = variant.strategy in ['sort', 'flow']
+    # Unseeded random tie-breaking cannot be repeated, so is never reused
+    if variant.strategy == 'random' and seed is None:
+        cache = None
+    blocks = list()
+    for key, puf_rows, scf_rows in strata:
+        if whole:
+            blocks.append([(0, len(puf_rows))])
+        elif cache is not None:
+            # Saved units are found again after PUF records are dropped or
+            # added only if their blocks are cut by content
+            blocks.append(ContentBlocks(recid[puf_rows], block_rows))
+        else:
+            blocks.append([(start, min(start + block_rows, len(puf_rows)))
+                           for start in range(0, len(puf_rows),
+                                              block_rows)])
+    units = [[None] * len(sblocks) for sblocks in blocks]
+    if cache is not None:
+        with report.stage('fingerprints'):
+            spec = {'strategy': variant.strategy,
+                    'features': variant.features}
+            if not whole:
+                spec['engine'] = engine
+            if variant.strategy != 'sort':
+                spec['metric'] = metric
+            if not whole and engine == 'grid':
+                spec['tolerance'] = tolerance
+            if variant.strategy == 'flow':
+                spec['candidates'] = candidates
+            if variant.strategy == 'random':
+                spec['seed'] = seed
+            if variant.strategy == 'knn':
+                spec['neighbours'] = neighbours
+                spec['kernel'] = kernel
+            if variant.strategy == 'caliper':
+                spec['caliper'] = caliper
+                spec['max_matches'] = max_matches
+            for s, (key, puf_rows, scf_rows) in enumerate(strata):
+                xa, awt, xb, mwgt = tasks[s]
+                sprint = Fingerprint(xb, mwgt, y1[scf_rows])
+                sspec = dict(spec, stratum=str(key))
+                units[s] = list()
+                for start, stop in blocks[s]:
+                    # The random draws of a block depend on its position in
+                    # the stream of the stratum
+                    if variant.strategy == 'random':
+                        sspec['start'] = start
+                    units[s].append(cache.key(
+                        sspec, sprint,
+                        Fingerprint(xa[start:stop], awt[start:stop],
+                                    recid[puf_rows[start:stop]])))
+
+    def _Load(s, u):
+        # Saved matchings of a unit, if any
+        if units[s][u] is None:
+            return None
+        with report.stage('cache'):
+            res = cache.load(units[s][u])
+        if res is not None:
+            report.count('cached_units')
+        return res
+
+    def _Save(s, u, res):
+        report.count('matched_units')
+        if units[s][u] is not None:
+            with report.stage('cache'):
+                cache.save(units[s][u], *res)
+
+    if workers > 1 and len(strata) > 1:
+        saved = [[_Load(s, u) for u in range(len(blocks[s]))]
+                 for s in range(len(strata))]
+        todo = [s for s in range(len(strata))
+                if any(res is None for res in saved[s])]
+        with report.stage('search'):
+            results = list()
+            if todo:
+                results = MapShared(MatchArrays, [tasks[s] for s in todo],
+                                    workers,
+                                    [{'rng': rngs[s], 'scale': scales[s]}
+                                     for s in todo],
+                                    strategy=variant.strategy,
+                                    engine=engine, mem_budget=mem_budget,
+                                    tolerance=tolerance,
+                                    candidates=candidates,
+                                    neighbours=neighbours, kernel=kernel,
+                                    caliper=caliper,
+                                    max_matches=max_matches)
+            for s, (i, j, wt) in zip(todo, results):
+                if whole:
+                    saved[s][0] = (i, j, wt)
+                    _Save(s, 0, saved[s][0])
+                    continue
+                # The matchings are in PUF order, so they can be divided
+                # into the blocks
+                for u, (start, stop) in enumerate(blocks[s]):
+                    lo, hi = np.searchsorted(i, [start, stop])
+                    saved[s][u] = (i[lo:hi] - start, j[lo:hi], wt[lo:hi])
+                    _Save(s, u, saved[s][u])
+            pieces = [_Piece(key, puf_rows[start:stop], scf_rows,
+                             *saved[s][u])
+                      for s, (key, puf_rows, scf_rows) in enumerate(strata)
+                      for u, (start, stop) in enumerate(blocks[s])]
+        for piece in pieces:
+            yield piece
+        return
+    for s, (key, puf_rows, scf_rows) in enumerate(strata):
+        xa, awt, xb, mwgt = tasks[s]
+        rng = rngs[s]
+        index = None
+        for u, (start, stop) in enumerate(blocks[s]):
+            res = _Load(s, u)
+            if res is None and not whole and index is None:
+                with report.stage('index'):
+                    index = data.index(variant.features, variant.strata, key,
+                                       scf_rows, engine, mem_budget,
+                                       tolerance, metric)
+            with report.stage('search'):
+                if res is not None:
+                    if rng is not None:
+                        # Skip the random numbers used by the saved unit,
+                        # one for each PUF record
+                        rng.bit_generator.advance(stop - start)
+                elif whole:
+                    res = MatchArrays(xa, awt, xb, mwgt, variant.strategy,
+                                      candidates=candidates,
+                                      scale=scales[s])
+                    _Save(s, u, res)
+                else:
+                    res = MatchArrays(xa[start:stop], awt[start:stop], xb,
+                                      mwgt, variant.strategy, index,
+                                      rng=rng, scale=scales[s],
+                                      neighbours=neighbours, kernel=kernel,
+                                      caliper=caliper,
+                                      max_matches=max_matches)
+                    _Save(s, u, res)
+                piece = _Piece(key, puf_rows[start:stop], scf_rows, *res)
+            yield piece
+
+
+def RunVariant(data, variant, workers=1, engine='index',
+               mem_budget=MEM_BUDGET, implicates=False, seed=None,
+               tolerance=TOLERANCE, candidates=CANDIDATES, cache=None,
+               metric='scaled', neighbours=NEIGHBOURS, kernel=KERNEL,
+               caliper=CALIPER, unmatched=None, replicates=None,
+               max_matches=MAX_MATCHES):
+    """
+    Runs one matching variant; see IterVariant for the arguments. It returns
+    a dataset of pairings of PUF and SCF records and the weight accorded to
+    each, plus the implicate when matching by implicate and the weight under
+    each replicate, as rep1, rep2, etc., when replicates are given.
+    """
+    names = ['pufseq', 'scf_seq', 'wgt']
+    if implicates:
+        names.append('implicate')
+    pieces = list(IterVariant(data, variant, workers, engine, mem_budget,
+                              implicates, seed=seed, tolerance=tolerance,
+                              candidates=candidates, cache=cache,
+                              metric=metric, neighbours=neighbours,
+                              kernel=kernel, caliper=caliper,
+                              unmatched=unmatched, replicates=replicates,
+                              max_matches=max_matches))
+    match1 = pd.DataFrame({name: np.concatenate([piece[k]
+                                                 for piece in pieces])
+                           for k, name in enumerate(names)})
+    if replicates is not None:
+        weights = np.concatenate([np.zeros((0, replicates.shape[1]))] +
+                                 [chunk for piece in pieces
+                                  for chunk in piece[-1]])
+        for k in range(weights.shape[1]):
+            match1['rep' + str(k + 1)] = weights[:, k]
+    return match1
+
+
+def CheckApproximation(data, variant, implicates=False, tolerance=TOLERANCE,
+                       records=CHECK_RECORDS, metric='scaled'):
+    """
+    Compares the matches of the approximate grid engine with those of the
+    exact search for a minimum distance variant, using about records PUF
+    records spread evenly over each stratum and the distance given by metric.
+    Returns the measures given by nearest.ApproxError, over all of the strata.
+    """
+    assert variant.strategy in ['split', 'random']
+    total = {'records': 0, 'non_exact': 0., 'non_nearest': 0.,
+             'max_excess': 0., 'mean_excess': 0.}
+    for key, puf_rows, scf_rows in data.strata(variant.strata, implicates):
+        if len(puf_rows) == 0 or len(scf_rows) == 0:
+            continue
+        n = -(-records * len(puf_rows) // len(data.puf))
+        rows = puf_rows[np.unique(np.linspace(0, len(puf_rows) - 1,
+                                              n).astype(np.int64))]
+        xa = data.matrix('puf', variant.features, rows)
+        xb = data.matrix('scf', variant.features, scf_rows)
+        whiten, scale = data.scaling(variant.features, variant.strata, key,
+                                     scf_rows, metric)
+        if whiten is not None:
+            xa = xa.dot(whiten.T)
+            xb = xb.dot(whiten.T)
+        approx = data.index(variant.features, variant.strata, key, scf_rows,
+                            'grid', tolerance=tolerance,
+                            metric=metric).ties(xa)
+        exact = data.index(variant.features, variant.strata, key, scf_rows,
+                           'index', metric=metric).ties(xa)
+        err = ApproxError(xa, xb, scale, approx, exact)
+        # Combine the strata, weighting the fractions by records
+        for name in ['non_exact', 'non_nearest', 'mean_excess']:
+            total[name] += err[name] * err['records']
+        total['max_excess'] = max(total['max_excess'], err['max_excess'])
+        total['records'] += err['records']
+    for name in ['non_exact', 'non_nearest', 'mean_excess']:
+        total[name] /= max(total['records'], 1)
+    return total
+
+
+def _ReadSCF(scf_path):
+    """
+    Reads the prepared SCF data, as CSV or a binary extract saved by
+    scf_prep.py.
+    """
+    if scf_path.endswith('.npz'):
+        return ReadExtract(scf_path)
+    return pd.read_csv(scf_path)
+
+
+def LoadDataYears(scf_path, puf_path='puf.csv', years=(2015,), report=None):
+    """
+    Reads in the SCF data and the PUF data aged to each of the given years,
+    aging the PUF once through all of them (see puf_cache.LoadPUFYears).
+    Returns a MatchData for each year, all sharing the SCF strata, moments and
+    search indexes, which are built once. The steps and the numbers of
+    records are recorded in report, if given.
+    """
+    report = report or RunReport()
+    with report.stage('scf'):
+        scf = _ReadSCF(scf_path)
+    with report.stage('puf'):
+        extracts = LoadPUFYears(puf_path, years, RECVARS, report=report)
+    with report.stage('income_measures'):
+        extracts = {year: AddIncomeMeasures(extracts[year])
+                    for year in years}
+    report.count('puf_records', sum(len(puf) for puf in extracts.values()))
+    report.count('scf_records', len(scf))
+    datasets = list()
+    with report.stage('hashes'):
+        scf_hash = FileHash(scf_path)
+        for year in years:
+            if datasets:
+                data = datasets[0].with_puf(extracts[year])
+            else:
+                data = MatchData(extracts[year], scf)
+            data.hashes = {'puf': CacheKey(puf_path, year, RECVARS),
+                           'scf': scf_hash}
+            datasets.append(data)
+    return datasets
+
+
+def _LoadPUFTask(puf_path, years):
+    """
+    Loads the PUF aged to each of the given years with the income measures,
+    in the background process of LoadDataPipelined. Returns the extracts and
+    cache keys by year and the report of the steps.
+    """
+    report = RunReport()
+    with report.stage('puf'):
+        extracts = LoadPUFYears(puf_path, years, RECVARS, report=report)
+    with report.stage('income_measures'):
+        extracts = {year: AddIncomeMeasures(extracts[year])
+                    for year in years}
+    keys = {year: CacheKey(puf_path, year, RECVARS) for year in years}
+    return extracts, keys, report
+
+
+def LoadDataPipelined(scf_path, puf_path='puf.csv', years=(2015,),
+                      variants=(), implicates=False, engine='index',
+                      mem_budget=MEM_BUDGET, tolerance=TOLERANCE,
+                      metric='scaled', indexes=True, report=None):
+    """
+    Reads in the data as LoadDataYears does, but loads and ages the PUF in a
+    background process while the SCF is read and the SCF side of each of
+    variants is prepared (see MatchData.prepare), so the matching can start
+    as soon as both are ready. The steps of the background process are
+    recorded in report as in LoadDataYears, and the time spent waiting for
+    it afterwards as wait_puf.
+    """
+    report = report or RunReport()
+    with concurrent.futures.ProcessPoolExecutor(1) as pool:
+        future = pool.submit(_LoadPUFTask, puf_path, list(years))
+        with report.stage('scf'):
+            scf = _ReadSCF(scf_path)
+        base = MatchData(None, scf)
+        with report.stage('prepare_scf'):
+            for variant in variants:
+                base.prepare(variant, implicates, engine, mem_budget,
+                             tolerance, metric, indexes)
+        with report.stage('hashes'):
+            scf_hash = FileHash(scf_path)
+        with report.stage('wait_puf'):
+            extracts, keys, puf_report = future.result()
+    report.merge(puf_report)
+    datasets = list()
+    for year in years:
+        data = base.with_puf(extracts[year])
+        data.hashes = {'puf': keys[year], 'scf': scf_hash}
+        datasets.append(data)
+    report.count('puf_records', sum(len(puf) for puf in extracts.values()))
+    report.count('scf_records', len(scf))
+    return datasets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Match the PUF and the SCF.')
+    parser.add_argument('variants', nargs='+',
+                        help='variants to run, e.g. 1C or split:income:age')
+    parser.add_argument('--scf', default=os.path.join(CUR_PATH, 'scf.csv'),
+                        help='prepared SCF data, CSV or a .npz extract from '
+                             'scf_prep.py (default: scf.csv)')
+    parser.add_argument('--puf', default='puf.csv',
+                        help='prepared PUF data (default: puf.csv)')
+    parser.add_argument('--year', type=int, default=2015,
+                        help='year to age the PUF to (default: 2015)')
+    parser.add_argument('--years', type=int, nargs='+', default=None,
+                        help='several years to age the PUF to in one pass, '
+                             'matching each against the same SCF indexes; '
+                             'the results are saved as '
+                             'match_<name>_<year>_results')
+    parser.add_argument('--outdir', default=CUR_PATH,
+                        help='directory for the results')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes for matching strata in parallel')
+    parser.add_argument('--engine', choices=ENGINES, default='index',
+                        help='search for minimum distance matching: sorted '
+                             'values/KD-tree (index), blocked brute force '
+                             '(brute) or an approximate search over grid '
+                             'cells (grid), within --tolerance')
+    parser.add_argument('--mem-budget', type=float, default=1024.,
+                        help='memory limit in MB for the brute-force search, '
+                             'the caliper range queries and the replicate '
+                             'weights (default: 1024)')
+    parser.add_argument('--metric', choices=METRICS, default='scaled',
+                        help='distance for minimum distance matching: each '
+                             'variable scaled by its variance (scaled) or '
+                             'the Mahalanobis distance (mahalanobis)')
+    parser.add_argument('--candidates', type=int, default=CANDIDATES,
+                        help='nearest SCF records considered for each PUF '
+                             'record in constrained matching (3x; default: '
+                             '10)')
+    parser.add_argument('--neighbours', type=int, default=NEIGHBOURS,
+                        help='nearest SCF records each PUF record is matched '
+                             'to in k-nearest matching (4x; default: 5)')
+    parser.add_argument('--kernel', choices=sorted(KERNELS), default=KERNEL,
+                        help='kernel of the distance for splitting the '
+                             'weight in k-nearest matching (4x; default: '
+                             'epanechnikov)')
+    parser.add_argument('--caliper', type=float, default=CALIPER,
+                        help='largest distance in standard deviations at '
+                             'which caliper matching (5x) matches records '
+                             '(default: 0.2)')
+    parser.add_argument('--max-matches', type=int, default=MAX_MATCHES,
+                        help='most SCF records a PUF record is matched to in '
+                             'caliper matching (5x), the nearest within the '
+                             'caliper (default: 100)')
+    parser.add_argument('--replicates', default=None,
+                        help='SCF replicate weight file (p16_rw1.dta); the '
+                             'weights of the matchings under each replicate '
+                             'are saved as match_<name>_replicates.npy (1x, '
+                             '4x and 5x)')
+    parser.add_argument('--max-replicates', type=int, default=None,
+                        help='use only the first replicates (default: all)')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='error bound in standard deviations for the '
+                             'approximate grid engine (default: 0.05)')
+    parser.add_argument('--implicates', action='store_true',
+                        help='match the PUF against each SCF implicate '
+                             'separately')
+    parser.add_argument('--format', choices=['bin', 'csv', 'both'],
+                        default='bin',
+                        help='output format: binary columnar (bin), CSV or '
+                             'both (default: bin)')
+    parser.add_argument('--wgt-dtype', choices=['float32', 'float64'],
+                        default='float64',
+                        help='type of the weights in binary output')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the random tie-breaking (2x), for '
+                             'reproducible results')
+    parser.add_argument('--incremental', action='store_true',
+                        help='save the matchings in cache/results and only '
+                             'rematch the strata and PUF blocks whose inputs '
+                             'changed since an earlier run')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='load and age the PUF in a background process '
+                             'while the SCF is read and its strata, moments '
+                             'and search indexes are prepared')
+    parser.add_argument('--report', default=None,
+                        help='file for the JSON run report (default: '
+                             'match_report.json in the output directory)')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the matching with cProfile and save '
+                             'the statistics next to the run report')
+    args = parser.parse_args(argv)
+    # Every variant is checked before any data is loaded
+    try:
+        variants = [ParseVariant(spec) for spec in args.variants]
+        for variant in variants:
+            CheckVariant(variant, args.engine, args.replicates is not None)
+    except ValueError as err:
+        parser.error(str(err))
+    os.makedirs(args.outdir, exist_ok=True)
+    report = RunReport(profile=args.profile)
+    cache = ResultCache() if args.incremental else None
+    report.info['argv'] = list(argv if argv is not None else sys.argv[1:])
+    years = args.years or [args.year]
+    with report.stage('load'):
+        if args.pipeline:
+            # Indexes built here are only used by the serial matching
+            datasets = LoadDataPipelined(args.scf, args.puf, years, variants,
+                                         args.implicates, args.engine,
+                                         int(args.mem_budget * 2**20),
+                                         args.tolerance, args.metric,
+                                         indexes=args.workers <= 1,
+                                         report=report)
+        else:
+            datasets = LoadDataYears(args.scf, args.puf, years, report)
+        repwgt = None
+        if args.replicates is not None:
+            with report.stage('replicates'):
+                repwgt = AlignReplicates(
+                    LoadReplicates(args.replicates, args.max_replicates),
+                    datasets[0].array('scf', 'Y1'))
+            report.count('replicates', repwgt.shape[1])
+    if args.years:
+        report.info['inputs'] = {str(year): data.hashes
+                                 for year, data in zip(years, datasets)}
+    else:
+        report.info['inputs'] = datasets[0].hashes
+    for year, data in zip(years, datasets):
+        for variant in variants:
+            name = variant.name
+            if args.years:
+                name += '_' + str(year)
+            with report.stage(name):
+                fname = os.path.join(args.outdir, 'match_' + name +
+                                     '_results')
+                writers = list()
+                if args.format in ['bin', 'both']:
+                    info = {'variant': variant._asdict(), 'year': year,
+                            'engine': args.engine,
+                            'implicates': args.implicates,
+                            'seed': args.seed, 'metric': args.metric,
+                            'inputs': data.hashes}
+                    if args.engine == 'grid':
+                        info['tolerance'] = args.tolerance
+                    if variant.strategy == 'knn':
+                        info['neighbours'] = args.neighbours
+                        info['kernel'] = args.kernel
+                    if variant.strategy == 'caliper':
+                        info['caliper'] = args.caliper
+                        info['max_matches'] = args.max_matches
+                    if repwgt is not None:
+                        info['replicates'] = repwgt.shape[1]
+                    writers.append(
+                        BinaryMatchWriter(fname + '.bin', info,
+                                          args.wgt_dtype,
+                                          implicates=args.implicates))
+                if args.format in ['csv', 'both']:
+                    writers.append(MatchWriter(fname + '.csv',
+                                               implicates=args.implicates))
+                # PUF records outside the caliper are saved separately
+                unmatched = None
+                if variant.strategy == 'caliper':
+                    unmatched = list()
+                    lost_writer = MatchWriter(
+                        os.path.join(args.outdir, 'match_' + name +
+                                     '_unmatched.csv'),
+                        implicates=args.implicates,
+                        columns=UNMATCHED_COLUMNS)
+                # Weights under each replicate are saved as a matrix
+                rep_writer = None
+                if repwgt is not None:
+                    rep_writer = ReplicateWriter(
+                        os.path.join(args.outdir, 'match_' + name +
+                                     '_replicates.npy'),
+                        repwgt.shape[1], args.wgt_dtype)
+                pieces = IterVariant(data, variant, args.workers, args.engine,
+                                     int(args.mem_budget * 2**20),
+                                     args.implicates, report=report,
+                                     seed=args.seed, tolerance=args.tolerance,
+                                     candidates=args.candidates, cache=cache,
+                                     metric=args.metric,
+                                     neighbours=args.neighbours,
+                                     kernel=args.kernel,
+                                     caliper=args.caliper,
+                                     unmatched=unmatched,
+                                     replicates=repwgt,
+                                     max_matches=args.max_matches)
+                # Time the matching and the writing of each piece separately
+                while True:
+                    with report.stage('match', profile=True):
+                        piece = next(pieces, None)
+                    if piece is None:
+                        break
+                    with report.stage('write'):
+                        if rep_writer is not None:
+                            for weights in piece[-1]:
+                                rep_writer.write(weights)
+                            piece = piece[:-1]
+                        for writer in writers:
+                            writer.write(*piece)
+                        while unmatched:
+                            lost_writer.write(*unmatched.pop(0))
+                with report.stage('write'):
+                    for writer in writers:
+                        writer.close()
+                    if unmatched is not None:
+                        lost_writer.close()
+                    if rep_writer is not None:
+                        rep_writer.close()
+            print('Matching complete: ' + name)
+            print('Length of PUF: ' + str(len(data.puf)))
+            print('Length of SCF: ' + str(len(data.scf)))
+            print('Length of Match: ' + str(writers[0].rows))
+            if unmatched is not None:
+                print('Unmatched PUF records: ' + str(lost_writer.rows))
+            if (args.engine == 'grid' and
+                    variant.strategy in ['split', 'random']):
+                # Measure how far the approximate matches are from exact ones
+                with report.stage(name):
+                    with report.stage('check'):
+                        err = CheckApproximation(data, variant,
+                                                 args.implicates,
+                                                 args.tolerance,
+                                                 metric=args.metric)
+                report.info.setdefault('approximation', {})[name] = err
+                print('Share of PUF records not matched exactly: {:.4f} '
+                      '(of {} checked)'.format(err['non_exact'],
+                                               err['records']))
+    report.write(args.report or
+                 os.path.join(args.outdir, 'match_report.json'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+This file computes the weighted means, variances and covariances of the
+matching variables. The minimum distance matching scales each variable by its
+weighted variance in the SCF, and the same statistics are needed by every
+variant and every implicate matched within a stratum. Moments computes them
+for all of the variables of a group of records together, and MatchData keeps
+them for each stratum, so they are computed once per run.
+
+The variances are computed exactly as the weighted variances of the original
+matching programs, so the distances, and therefore the matchings, are the same
+as theirs. The covariances make it possible to use the Mahalanobis distance,
+    sqrt((xb - xa)' inv(C) (xb - xa))
+with C the weighted covariance matrix of the SCF variables, in place of the
+distance scaled by the variances, which ignores the correlation between
+variables (e.g. between age and passive income).
+"""
+import numpy as np
+
+
+class Moments(object):
+    """
+    Weighted moments of the columns of x, named by names, with weights wgt:
+    the total weight, the mean of each column and the covariance matrix,
+    normalized by the total weight.
+    """
+
+    def __init__(self, x, wgt, names=None):
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim == 1:
+            x = x[:, np.newaxis]
+        wgt = np.asarray(wgt, dtype=np.float64)
+        if names is None:
+            names = list(range(x.shape[1]))
+        assert len(names) == x.shape[1]
+        self.names = list(names)
+        self.total = np.sum(wgt)
+        # Center each column as in the original weighted variance
+        centered = np.empty(x.shape, order='F')
+        self.mean = np.zeros(x.shape[1])
+        for k in range(x.shape[1]):
+            col = np.ascontiguousarray(x[:, k])
+            self.mean[k] = np.average(col, weights=wgt)
+            centered[:, k] = col - self.mean[k]
+        # All of the cross products at once, with the variances on the
+        # diagonal recomputed in the same way as the original variances
+        self.cov = (centered * wgt[:, np.newaxis]).T.dot(centered)
+        self.cov /= self.total
+        for k in range(x.shape[1]):
+            self.cov[k, k] = np.average(centered[:, k]**2, weights=wgt)
+
+    def _Positions(self, names):
+        return [self.names.index(name) for name in names]
+
+    def variances(self, names=None):
+        """
+        Returns the variances of the named columns (all by default).
+        """
+        pos = self._Positions(names if names is not None else self.names)
+        return self.cov.diagonal()[pos].copy()
+
+    def covariance(self, names=None):
+        """
+        Returns the covariance matrix of the named columns (all by default).
+        """
+        pos = self._Positions(names if names is not None else self.names)
+        return self.cov[np.ix_(pos, pos)]
+
+    def whitening(self, names=None):
+        """
+        Returns the matrix W such that the Euclidean distance between the
+        rows of x.dot(W.T) is the Mahalanobis distance between the rows of x,
+        for the named columns of x.
+        """
+        cov = self.covariance(names)
+        try:
+            lower = np.linalg.cholesky(cov)
+        except np.linalg.LinAlgError:
+            raise ValueError('covariance matrix of ' + str(names) +
+                             ' is singular')
+        return np.linalg.inv(lower)
+
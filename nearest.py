@@ -0,0 +1,1075 @@
+"""
+This file holds the nearest-neighbour engine used by the minimum distance
+matching programs. Rather than computing the distance from each PUF record to
+every SCF record, the SCF values are sorted once and the nearest value for all
+of the PUF records is found together with a binary search. When matching on
+several variables, each variable is scaled by its SCF variance and a KD-tree
+is built over the SCF points instead.
+
+Every SCF record at the minimum distance is kept, so the matches can either be
+split across the ties (the 1x programs) or one tie can be selected at random
+(the 2x programs). The tied SCF records for each PUF record are stored in
+compressed sparse row form: the ties for PUF record i are
+    cand[offsets[i]:offsets[i+1]]
+with the SCF positions listed in their original order. SCF records with the
+same values can be collapsed into unique points first with CompressedIndex, so
+that the search only runs over the unique points. The same searches can be
+done by brute force with BlockedIndex, which processes the PUF records in
+blocks sized to a memory budget, or approximately with GridIndex, which only
+compares each PUF record with a few SCF points in each of the nearest cells of
+a grid, for quick exploratory runs.
+
+For soft matching (the 4x programs), MatchKernelArrays matches each PUF record
+to its k nearest SCF records instead, found by a partial selection over the
+candidates (np.argpartition) rather than a full sort, and splits the weight
+between them by a kernel of the distance. For caliper matching (the 5x
+programs), MatchCaliperArrays matches each PUF record to every SCF record
+within a given distance, found with a range query on the same structures, or
+to the nearest MAX_MATCHES of them when there are more. The SCF records within
+the distance are counted before they are listed, so the PUF records can be
+matched in batches whose working memory fits a budget.
+
+The SCF records matched to each PUF record do not depend on the SCF weights,
+so to reweight the matchings with the SCF replicate weights, SplitReplicates
+only redoes the weight split, for all of the replicates at once.
+"""
+import itertools
+import numpy as np
+
+# Number of SCF records each PUF record is matched to by MatchKernelArrays,
+# and the default kernel for splitting the weight between them
+NEIGHBOURS = 5
+KERNEL = 'epanechnikov'
+
+# Default limit on the SCF records each PUF record is matched to by
+# MatchCaliperArrays, and the approximate bytes of working memory for each
+# pair of records found by a range query, used to size its batches
+MAX_MATCHES = 100
+PAIR_BYTES = 160
+
+# Approximate bytes of working memory for each weight of a matching under a
+# replicate in SplitReplicates, used to size its chunks
+REPLICATE_BYTES = 24
+
+# Most points of a cell of GridIndex that each PUF record is compared with
+CELL_POINTS = 8
+
+# Kernels of the distance divided by the bandwidth
+KERNELS = {'uniform': lambda ratio: np.ones_like(ratio),
+           'triangular': lambda ratio: np.maximum(1. - ratio, 0.),
+           'epanechnikov': lambda ratio: np.maximum(1. - ratio**2, 0.),
+           'gaussian': lambda ratio: np.exp(-0.5 * ratio**2)}
+
+
+def _ExpandBlocks(starts, counts):
+    """
+    Returns the concatenation of the ranges starts[i]:starts[i]+counts[i].
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    total = int(counts.sum())
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    shift = np.repeat(np.asarray(starts, dtype=np.int64) - offsets[:-1],
+                      counts)
+    return np.arange(total, dtype=np.int64) + shift
+
+
+def _SegmentSum(values, offsets):
+    """
+    Sums values within each segment values[offsets[i]:offsets[i+1]]. The
+    additions are done in order within each segment, so the totals are the same
+    as those given by sum() on each segment separately.
+    """
+    counts = np.diff(offsets)
+    totals = np.zeros(len(counts))
+    if len(counts) == 0:
+        return totals
+    # Sort the segments by length so the k-th pass only visits segments with
+    # more than k entries
+    order = np.argsort(-counts, kind='mergesort')
+    sorted_counts = counts[order]
+    starts = offsets[:-1][order]
+    for k in range(int(sorted_counts[0])):
+        n = np.searchsorted(-sorted_counts, -k, side='left')
+        totals[order[:n]] += values[starts[:n] + k]
+    return totals
+
+
+def _Batches(counts, limit):
+    """
+    Cuts the rows with the given counts into runs (start, stop) whose counts
+    add up to at most limit, or into single rows where one row exceeds it.
+    """
+    ends = np.cumsum(counts)
+    bounds = [0]
+    while bounds[-1] < len(ends):
+        start = bounds[-1]
+        base = ends[start - 1] if start > 0 else 0
+        stop = int(np.searchsorted(ends, base + limit, side='right'))
+        bounds.append(max(stop, start + 1))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _NearestK(rows, dist, cand, n, k):
+    """
+    Keeps the k nearest of the candidates (rows, dist, cand) of each of n PUF
+    records, where each record has at least k, with ties in distance taken in
+    SCF order. Returns (dist, cand), both arrays with a row for each record,
+    ordered by distance and then SCF position.
+    """
+    order = np.lexsort((cand, dist, rows))
+    counts = np.bincount(rows, minlength=n)
+    starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    keep = order[np.arange(len(order)) - starts[rows[order]] < k]
+    return dist[keep].reshape(n, k), cand[keep].reshape(n, k)
+
+
+def _SortRows(dist, cand):
+    """
+    Sorts each row of (dist, cand) by distance and then SCF position.
+    """
+    order = np.argsort(cand, axis=1, kind='mergesort')
+    dist = np.take_along_axis(dist, order, axis=1)
+    cand = np.take_along_axis(cand, order, axis=1)
+    order = np.argsort(dist, axis=1, kind='mergesort')
+    return (np.take_along_axis(dist, order, axis=1),
+            np.take_along_axis(cand, order, axis=1))
+
+
+def _Tied(dist, k):
+    """
+    Marks the rows of dist, each holding the distances to the nearest points
+    in order, whose kth and (k+1)th nearest may be at the same distance,
+    allowing for rounding.
+    """
+    if dist.shape[1] <= k:
+        return np.zeros(len(dist), dtype=bool)
+    return dist[:, k] <= dist[:, k - 1] * (1. + 1e-8) + 1e-10
+
+
+def Distance(xa, xb, scale):
+    """
+    Calculates the distance between the rows of xa and xb, defined as
+        sqrt(sum_k (xb_k - xa_k)^2 / scale_k)
+    The terms are added in the same order as in the matching programs.
+    """
+    dist = 0.
+    for k in range(len(scale)):
+        dist = dist + (xb[:, k] - xa[:, k])**2 / scale[k]
+    return np.sqrt(dist)
+
+
+class NearestIndex(object):
+    """
+    Search structure over a set of SCF points, built once and queried for any
+    number of PUF records. With one matching variable, the SCF values are
+    sorted and grouped into blocks of equal values. With several, each
+    variable is divided by the square root of scale (the SCF variance) and a
+    KD-tree is built over the scaled points.
+    """
+
+    def __init__(self, xb, scale=None):
+        xb = np.asarray(xb, dtype=np.float64)
+        if xb.ndim == 1:
+            xb = xb[:, np.newaxis]
+        self.xb = xb
+        self.size = len(xb)
+        if xb.shape[1] == 1:
+            self.scale = None
+            # Sort the SCF values once and find the block at each value
+            self.order = np.argsort(xb[:, 0], kind='mergesort')
+            self.sorted = xb[self.order, 0]
+            self.uniq, self.starts, self.sizes = np.unique(
+                xb[self.order, 0], return_index=True, return_counts=True)
+        else:
+            from scipy.spatial import cKDTree
+            self.scale = np.asarray(scale, dtype=np.float64)
+            self.sd = np.sqrt(self.scale)
+            self.tree = cKDTree(xb / self.sd)
+
+    def ties(self, xa):
+        """
+        For each row of xa, finds every SCF point at the minimum distance.
+        Returns the ties in CSR form as (offsets, cand).
+        """
+        xa = np.asarray(xa, dtype=np.float64)
+        if xa.ndim == 1:
+            xa = xa[:, np.newaxis]
+        if self.scale is None:
+            return self._Ties1D(xa[:, 0])
+        return self._TiesTree(xa)
+
+    def nearest(self, xa, k):
+        """
+        For each row of xa, finds the k nearest SCF points (all of them if
+        there are fewer). Points at the same distance are taken in SCF order,
+        so the k are the same for every search structure. Returns (dist,
+        cand), both arrays with a row for each row of xa, ordered by distance
+        and then SCF position.
+        """
+        xa = np.asarray(xa, dtype=np.float64)
+        if xa.ndim == 1:
+            xa = xa[:, np.newaxis]
+        n = len(xa)
+        k = min(k, self.size)
+        # One more than k is found, to tell whether the kth is tied
+        kq = min(k + 1, self.size)
+        if self.scale is not None:
+            _, cand = self.tree.query(xa / self.sd, k=kq)
+            cand = cand.reshape(n, kq)
+        else:
+            # The kq nearest values are among the kq sorted values on either
+            # side of each PUF value
+            inca = xa[:, 0]
+            pos = np.searchsorted(self.sorted, inca)
+            window = pos[:, np.newaxis] + np.arange(-kq, kq)
+            valid = (window >= 0) & (window < self.size)
+            window = np.clip(window, 0, self.size - 1)
+            dist = np.where(valid, np.abs(self.sorted[window] -
+                                          inca[:, np.newaxis]), np.inf)
+            sel = np.argpartition(dist, kq - 1, axis=1)[:, :kq]
+            cand = self.order[np.take_along_axis(window, sel, axis=1)]
+        rows = np.repeat(np.arange(n), kq)
+        dist = self.distance(xa[rows], cand.reshape(-1)).reshape(n, kq)
+        dist, cand = _SortRows(dist, cand)
+        tied = np.flatnonzero(_Tied(dist, k))
+        dist = dist[:, :k].copy()
+        cand = cand[:, :k].copy()
+        if len(tied) > 0:
+            # Every point at or within the kth distance, from which the k
+            # are taken in SCF order
+            xt = xa[tied]
+            offsets, tcand = self.within(xt, dist[tied, k - 1])
+            trows = np.repeat(np.arange(len(tied)), np.diff(offsets))
+            dist[tied], cand[tied] = _NearestK(
+                trows, self.distance(xt[trows], tcand), tcand, len(tied), k)
+        return dist, cand
+
+    def distance(self, xa, cand):
+        """
+        Returns the distance from each row of xa to the SCF point cand in the
+        same position.
+        """
+        if self.scale is None:
+            return np.abs(self.xb[cand, 0] - xa[:, 0])
+        return Distance(xa, self.xb[cand], self.scale)
+
+    def _Window(self, inca, radius):
+        # The sorted positions of the values within radius, allowing for
+        # rounding in the bounds; the distances are checked afterwards
+        pad = radius * 1e-8 + 1e-10
+        lo = np.searchsorted(self.sorted, inca - radius - pad, side='left')
+        hi = np.searchsorted(self.sorted, inca + radius + pad, side='right')
+        return lo, hi
+
+    def count_within(self, xa, radius):
+        """
+        For each row of xa, returns the number of SCF points within the
+        distance radius, or a slight overcount, without listing them.
+        """
+        xa = np.asarray(xa, dtype=np.float64)
+        if xa.ndim == 1:
+            xa = xa[:, np.newaxis]
+        if self.scale is not None:
+            counts = self.tree.query_ball_point(
+                xa / self.sd, np.asarray(radius) * (1. + 1e-8) + 1e-10,
+                return_length=True)
+            return np.asarray(counts, dtype=np.int64)
+        lo, hi = self._Window(xa[:, 0], radius)
+        return hi - lo
+
+    def within(self, xa, radius):
+        """
+        For each row of xa, finds every SCF point within the distance radius,
+        which may be given for each row. Returns them in CSR form as
+        (offsets, cand).
+        """
+        xa = np.asarray(xa, dtype=np.float64)
+        if xa.ndim == 1:
+            xa = xa[:, np.newaxis]
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64),
+                                 (len(xa),))
+        if self.scale is not None:
+            # Allow for rounding differences between the scaled and unscaled
+            # distances, as in _TiesTree
+            lists = self.tree.query_ball_point(xa / self.sd,
+                                               radius * (1. + 1e-8) + 1e-10,
+                                               return_sorted=True)
+            counts = np.fromiter(map(len, lists), dtype=np.int64,
+                                 count=len(lists))
+            cand = np.fromiter(itertools.chain.from_iterable(lists),
+                               dtype=np.int64, count=int(counts.sum()))
+            rows = np.repeat(np.arange(len(xa)), counts)
+            keep = self.distance(xa[rows], cand) <= radius[rows]
+        else:
+            # The points within the radius are a run of the sorted values
+            inca = xa[:, 0]
+            lo, hi = self._Window(inca, radius)
+            counts = hi - lo
+            sel = _ExpandBlocks(lo, counts)
+            rows = np.repeat(np.arange(len(xa)), counts)
+            keep = np.abs(self.sorted[sel] - inca[rows]) <= radius[rows]
+            # Restore the SCF order within each PUF record
+            cand = self.order[sel]
+            order = np.lexsort((cand, rows))
+            cand = cand[order]
+            keep = keep[order]
+        counts = np.bincount(rows[keep], minlength=len(xa))
+        offsets = np.zeros(len(xa) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, cand[keep]
+
+    def _Ties1D(self, inca):
+        order = self.order
+        uniq = self.uniq
+        starts = self.starts
+        sizes = self.sizes
+        # Nearest unique value on each side of every PUF value
+        pos = np.searchsorted(uniq, inca)
+        left = np.maximum(pos - 1, 0)
+        right = np.minimum(pos, len(uniq) - 1)
+        dleft = np.where(pos > 0, np.abs(uniq[left] - inca), np.inf)
+        dright = np.where(pos < len(uniq), np.abs(uniq[right] - inca), np.inf)
+        take_left = dleft <= dright
+        take_right = dright <= dleft
+        # Gather the tie blocks; a PUF value exactly between two SCF values
+        # takes both blocks
+        nleft = np.where(take_left, sizes[left], 0)
+        nright = np.where(take_right, sizes[right], 0)
+        counts = nleft + nright
+        offsets = np.zeros(len(inca) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        cand = np.empty(offsets[-1], dtype=np.int64)
+        lpos = _ExpandBlocks(offsets[:-1], nleft)
+        cand[lpos] = order[_ExpandBlocks(starts[left], nleft)]
+        rpos = _ExpandBlocks(offsets[:-1] + nleft, nright)
+        cand[rpos] = order[_ExpandBlocks(starts[right], nright)]
+        # Restore the SCF order for records that took two blocks
+        both = np.flatnonzero(take_left & take_right & (left != right))
+        if len(both) > 0:
+            sel = _ExpandBlocks(offsets[both], counts[both])
+            rows = np.repeat(np.arange(len(both)), counts[both])
+            cand[sel] = cand[sel][np.lexsort((cand[sel], rows))]
+        return offsets, cand
+
+    def _TiesTree(self, xa):
+        qa = xa / self.sd
+        dmin, _ = self.tree.query(qa, k=1)
+        # Collect every SCF point that could be at the minimum distance,
+        # allowing for rounding differences between the scaled and unscaled
+        # distances
+        radius = dmin * (1. + 1e-8) + 1e-10
+        lists = self.tree.query_ball_point(qa, radius, return_sorted=True)
+        counts = np.fromiter(map(len, lists), dtype=np.int64,
+                             count=len(lists))
+        cand = np.fromiter(itertools.chain.from_iterable(lists),
+                           dtype=np.int64, count=int(counts.sum()))
+        rows = np.repeat(np.arange(len(xa)), counts)
+        # Keep the points at exactly the minimum of the unscaled distance
+        dist = Distance(xa[rows], self.xb[cand], self.scale)
+        starts = np.zeros(len(xa), dtype=np.int64)
+        np.cumsum(counts[:-1], out=starts[1:])
+        keep = dist == np.minimum.reduceat(dist, starts)[rows]
+        counts = np.bincount(rows[keep], minlength=len(xa))
+        offsets = np.zeros(len(xa) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, cand[keep]
+
+
+class BlockedIndex(object):
+    """
+    Exact search over a set of SCF points by brute force. The distance from
+    every PUF record to every SCF point is computed as in Distance, but the
+    PUF records are processed in blocks sized so that the working arrays fit
+    in mem_budget bytes. Only the minimum distance and the tied SCF points are
+    kept for each PUF record.
+    """
+
+    def __init__(self, xb, scale=None, mem_budget=2**30):
+        xb = np.asarray(xb, dtype=np.float64)
+        if xb.ndim == 1:
+            xb = xb[:, np.newaxis]
+        self.xb = xb
+        self.size = len(xb)
+        self.scale = scale
+        if scale is not None:
+            self.scale = np.asarray(scale, dtype=np.float64)
+        # Two float arrays and one boolean array per PUF record in a block
+        self.block = max(1, int(mem_budget // (17 * max(len(xb), 1))))
+
+    def ties(self, xa):
+        """
+        For each row of xa, finds every SCF point at the minimum distance.
+        Returns the ties in CSR form as (offsets, cand).
+        """
+        xa = np.asarray(xa, dtype=np.float64)
+        if xa.ndim == 1:
+            xa = xa[:, np.newaxis]
+        counts = np.zeros(len(xa), dtype=np.int64)
+        cands = list()
+        for start in range(0, len(xa), self.block):
+            stop = min(start + self.block, len(xa))
+            rows, cols = self._BlockTies(xa[start:stop])
+            counts[start:stop] = np.bincount(rows, minlength=stop - start)
+            cands.append(cols)
+        offsets = np.zeros(len(xa) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        cand = np.concatenate(cands) if cands else np.zeros(0, np.int64)
+        return offsets, cand.astype(np.int64)
+
+    def nearest(self, xa, k):
+        """
+        For each row of xa, finds the k nearest SCF points (all of them if
+        there are fewer), with points at the same distance taken in SCF
+        order, as NearestIndex.nearest does. Returns (dist, cand), both
+        arrays with a row for each row of xa, ordered by distance and then
+        SCF position.
+        """
+        xa = np.asarray(xa, dtype=np.float64)
+        if xa.ndim == 1:
+            xa = xa[:, np.newaxis]
+        k = min(k, self.size)
+        dist = np.empty((len(xa), k))
+        cand = np.empty((len(xa), k), dtype=np.int64)
+        for start in range(0, len(xa), self.block):
+            stop = min(start + self.block, len(xa))
+            bdist = self._BlockDistances(xa[start:stop])
+            # The partitioned copy takes the place of the second float array
+            # of _BlockDistances, and the two masks that of its boolean array
+            part = bdist.copy()
+            part.partition(k - 1, axis=1)
+            kth = part[:, k - 1:k].copy()
+            del part
+            # Every point nearer than the kth distance, and the first of
+            # those at it in SCF order, found from their positions rather
+            # than a running count over the whole block
+            rows, cols = np.nonzero(bdist < kth)
+            nnear = np.bincount(rows, minlength=stop - start)
+            pos = np.arange(len(rows)) - np.repeat(np.cumsum(nnear) - nnear,
+                                                   nnear)
+            trows, tcols = np.nonzero(bdist == kth)
+            nat = np.bincount(trows, minlength=stop - start)
+            tpos = np.arange(len(trows)) - np.repeat(np.cumsum(nat) - nat,
+                                                     nat) + nnear[trows]
+            keep = tpos < k
+            bcand = np.empty((stop - start, k), dtype=np.int64)
+            bcand[rows, pos] = cols
+            bcand[trows[keep], tpos[keep]] = tcols[keep]
+            dist[start:stop], cand[start:stop] = _SortRows(
+                np.take_along_axis(bdist, bcand, axis=1), bcand)
+            del bdist
+        return dist, cand
+
+    def distance(self, xa, cand):
+        """
+        Returns the distance from each row of xa to the SCF point cand in the
+        same position.
+        """
+        if self.scale is None:
+            return np.abs(self.xb[cand, 0] - xa[:, 0])
+        return Distance(xa, self.xb[cand], self.scale)
+
+    def count_within(self, xa, radius):
+        """
+        For each row of xa, returns the number of SCF points within the
+        distance radius.
+        """
+        xa = np.asarray(xa, dtype=np.float64)
+        if xa.ndim == 1:
+            xa = xa[:, np.newaxis]
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64),
+                                 (len(xa),))[:, np.newaxis]
+        counts = np.zeros(len(xa), dtype=np.int64)
+        for start in range(0, len(xa), self.block):
+            stop = min(start + self.block, len(xa))
+            counts[start:stop] = np.count_nonzero(
+                self._BlockDistances(xa[start:stop]) <= radius[start:stop],
+                axis=1)
+        return counts
+
+    def within(self, xa, radius):
+        """
+        For each row of xa, finds every SCF point within the distance radius,
+        which may be given for each row. Returns them in CSR form as
+        (offsets, cand).
+        """
+        xa = np.asarray(xa, dtype=np.float64)
+        if xa.ndim == 1:
+            xa = xa[:, np.newaxis]
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64),
+                                 (len(xa),))[:, np.newaxis]
+        counts = np.zeros(len(xa), dtype=np.int64)
+        cands = list()
+        for start in range(0, len(xa), self.block):
+            stop = min(start + self.block, len(xa))
+            rows, cols = np.nonzero(self._BlockDistances(xa[start:stop]) <=
+                                    radius[start:stop])
+            counts[start:stop] = np.bincount(rows, minlength=stop - start)
+            cands.append(cols)
+        offsets = np.zeros(len(xa) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        cand = np.concatenate(cands) if cands else np.zeros(0, np.int64)
+        return offsets, cand.astype(np.int64)
+
+    def _BlockTies(self, xa):
+        dist = self._BlockDistances(xa)
+        dmin = dist.min(axis=1)
+        return np.nonzero(dist == dmin[:, np.newaxis])
+
+    def _BlockDistances(self, xa):
+        xb = self.xb
+        dist = np.zeros((len(xa), len(xb)))
+        term = np.empty_like(dist)
+        if self.scale is None:
+            np.subtract(xb[np.newaxis, :, 0], xa[:, 0, np.newaxis], out=dist)
+            np.abs(dist, out=dist)
+        else:
+            for k in range(len(self.scale)):
+                np.subtract(xb[np.newaxis, :, k], xa[:, k, np.newaxis],
+                            out=term)
+                np.square(term, out=term)
+                term /= self.scale[k]
+                dist += term
+            np.sqrt(dist, out=dist)
+        del term
+        return dist
+
+
+class GridIndex(object):
+    """
+    Approximate search over a set of distinct SCF points. Each variable is
+    divided by the square root of scale (the SCF variance) and the scaled
+    space is cut into cubic cells. Each cell is represented by at most
+    cell_points of its points, those nearest the mean of its points weighted
+    by wgt. For each PUF record, the nearest occupied cells to the cell it
+    falls in are found, and the ties are the representatives of those cells
+    at the minimum distance from the record. A PUF record is compared with
+    at most cell_points points per cell, however many points the cell holds,
+    and PUF records in the same cell look up the cells once, so coarser
+    cells, from a larger tolerance, make the search faster as well as less
+    exact.
+
+    The cell width is tolerance / (2 sqrt(d)) for d variables, so each point
+    is within tolerance / 4 of its cell center, and every SCF point selected
+    for a PUF record is at most tolerance further away, in the scaled
+    distance, than the nearest SCF point.
+    """
+
+    def __init__(self, xb, scale, tolerance, wgt=None,
+                 cell_points=CELL_POINTS):
+        xb = np.asarray(xb, dtype=np.float64)
+        if xb.ndim == 1:
+            xb = xb[:, np.newaxis]
+        assert tolerance > 0
+        self.xb = xb
+        self.size = len(xb)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        sd = np.sqrt(self.scale)
+        self.sd = np.where(sd > 0, sd, 1.)
+        self.width = tolerance / (2. * np.sqrt(xb.shape[1]))
+        cells, inverse = np.unique(self._Cells(xb), axis=0,
+                                   return_inverse=True)
+        inverse = inverse.reshape(-1)
+        members = np.argsort(inverse, kind='mergesort')
+        moffsets = np.zeros(len(cells) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(inverse, minlength=len(cells)),
+                  out=moffsets[1:])
+        cell = inverse[members]
+        # The weighted mean of each cell, or the plain mean of cells with no
+        # weight
+        wgt = np.ones(len(xb)) if wgt is None else np.asarray(wgt, np.float64)
+        w = wgt[members][:, np.newaxis]
+        wsum = np.add.reduceat(w, moffsets[:-1])
+        means = np.add.reduceat(xb[members] * w, moffsets[:-1]) / \
+            np.where(wsum > 0, wsum, 1.)
+        plain = np.add.reduceat(xb[members], moffsets[:-1]) / \
+            np.diff(moffsets)[:, np.newaxis]
+        means = np.where(wsum > 0, means, plain)
+        # The representatives of each cell are its points nearest the mean
+        dist = Distance(xb[members], means[cell], self.scale)
+        order = np.lexsort((members, dist, cell))
+        rank = np.arange(len(members)) - moffsets[cell[order]]
+        chosen = order[rank < cell_points]
+        self.reps = members[chosen]
+        self.roffsets = np.zeros(len(cells) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell[chosen], minlength=len(cells)),
+                  out=self.roffsets[1:])
+        # The distance between cell numbers is the scaled distance between
+        # cell centers divided by the width, so the nearest cells are the
+        # same
+        cell_scale = None
+        if xb.shape[1] > 1:
+            cell_scale = np.ones(xb.shape[1])
+        self.cell_index = NearestIndex(cells.astype(np.float64), cell_scale)
+
+    def _Cells(self, x):
+        """
+        Returns the cell numbers of the rows of x.
+        """
+        return np.floor(x / self.sd / self.width).astype(np.int64)
+
+    def ties(self, xa):
+        """
+        For each row of xa, finds every representative of the nearest
+        occupied cells at the minimum distance. Returns the ties in CSR form
+        as (offsets, cand).
+        """
+        xa = np.asarray(xa, dtype=np.float64)
+        if xa.ndim == 1:
+            xa = xa[:, np.newaxis]
+        n = len(xa)
+        if n == 0:
+            return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        cells, inverse = np.unique(self._Cells(xa), axis=0,
+                                   return_inverse=True)
+        inverse = inverse.reshape(-1)
+        # Representatives of the cells tied for each distinct PUF cell
+        coffsets, ccand = self.cell_index.ties(cells.astype(np.float64))
+        ccounts = np.diff(coffsets)
+        rcounts = np.diff(self.roffsets)[ccand]
+        qcand = self.reps[_ExpandBlocks(self.roffsets[ccand], rcounts)]
+        crows = np.repeat(np.arange(len(cells)), ccounts)
+        qcounts = np.bincount(crows, weights=rcounts,
+                              minlength=len(cells)).astype(np.int64)
+        qoffsets = np.zeros(len(cells) + 1, dtype=np.int64)
+        np.cumsum(qcounts, out=qoffsets[1:])
+        # Copy them to the PUF records in each cell and keep those at the
+        # minimum distance, in SCF order
+        counts = qcounts[inverse]
+        starts = np.zeros(n, dtype=np.int64)
+        np.cumsum(counts[:-1], out=starts[1:])
+        cand = qcand[_ExpandBlocks(qoffsets[inverse], counts)]
+        rows = np.repeat(np.arange(n), counts)
+        dist = Distance(xa[rows], self.xb[cand], self.scale)
+        keep = dist == np.minimum.reduceat(dist, starts)[rows]
+        rows = rows[keep]
+        cand = cand[keep]
+        order = np.lexsort((cand, rows))
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+        return offsets, cand[order]
+
+
+def ApproxError(xa, xb, scale, approx, exact):
+    """
+    Compares the ties found by an approximate search, approx, with those
+    found by the exact search, exact, both given in CSR form as
+    (offsets, cand) for the PUF points xa and SCF points xb. Returns a
+    dictionary with the number of PUF records, the fraction of them whose
+    ties differ from the exact ties (non_exact), the fraction matched to an
+    SCF record further away than the nearest (non_nearest), and the largest
+    and mean excess scaled distance of the matched SCF records.
+    """
+    xa = np.asarray(xa, dtype=np.float64)
+    xb = np.asarray(xb, dtype=np.float64)
+    if xa.ndim == 1:
+        xa = xa[:, np.newaxis]
+        xb = xb[:, np.newaxis]
+    aoffsets, acand = approx
+    eoffsets, ecand = exact
+    n = len(xa)
+    if n == 0:
+        return {'records': 0, 'non_exact': 0., 'non_nearest': 0.,
+                'max_excess': 0., 'mean_excess': 0.}
+    acounts = np.diff(aoffsets)
+    ecounts = np.diff(eoffsets)
+    arows = np.repeat(np.arange(n), acounts)
+    erows = np.repeat(np.arange(n), ecounts)
+    adist = Distance(xa[arows], xb[acand], scale)
+    edist = Distance(xa[erows], xb[ecand], scale)
+    dmin = edist[eoffsets[:-1]]
+    excess = np.zeros(n)
+    np.maximum.at(excess, arows, adist - dmin[arows])
+    # Ties are the same when the counts and the SCF records agree
+    same = acounts == ecounts
+    rows = np.flatnonzero(same)
+    sel_a = _ExpandBlocks(aoffsets[rows], acounts[rows])
+    sel_e = _ExpandBlocks(eoffsets[rows], ecounts[rows])
+    differ = acand[sel_a] != ecand[sel_e]
+    same[rows[np.unique(np.repeat(np.arange(len(rows)),
+                                  acounts[rows])[differ])]] = False
+    return {'records': n,
+            'non_exact': float(np.mean(~same)),
+            'non_nearest': float(np.mean(excess > 0)),
+            'max_excess': float(excess.max()),
+            'mean_excess': float(excess.mean())}
+
+
+class CompressedIndex(object):
+    """
+    Search over the SCF points after collapsing records with identical match
+    keys into unique points. Because of the multiple imputation, many SCF
+    records share the same values, and the search only needs to consider each
+    set of values once. For each unique point, its member records are stored
+    in CSR form, members[moffsets[u]:moffsets[u+1]] in their original order,
+    along with each member's share of the point's total weight. The search
+    itself is done by base_index over the unique points, which is built by
+    the function make_index(points, weights), given the total weight of each
+    point. Range queries over the unique points
+    are listed in batches that fit in mem_budget bytes.
+    """
+
+    def __init__(self, xb, mwgt, make_index, mem_budget=2**30):
+        xb = np.asarray(xb, dtype=np.float64)
+        if xb.ndim == 1:
+            xb = xb[:, np.newaxis]
+        mwgt = np.asarray(mwgt, dtype=np.float64)
+        self.size = len(xb)
+        self.mwgt = mwgt
+        self.points, inverse = np.unique(xb, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        self.members = np.argsort(inverse, kind='mergesort')
+        self.moffsets = np.zeros(len(self.points) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(inverse, minlength=len(self.points)),
+                  out=self.moffsets[1:])
+        mcounts = np.diff(self.moffsets)
+        self.totals = _SegmentSum(mwgt[self.members], self.moffsets)
+        self.shares = (mwgt[self.members] /
+                       np.repeat(self.totals, mcounts))
+        self.base_index = make_index(self.points, self.totals)
+        self.mem_budget = mem_budget
+
+    def _Expand(self, xa, radius=None):
+        """
+        Finds the tied unique points for each row of xa, or those within the
+        distance radius if it is given, and expands them to their member
+        records. Returns (offsets, cand, share, multi), where multi marks the
+        rows with more than one unique point.
+        """
+        if radius is None:
+            uoffsets, ucand = self.base_index.ties(xa)
+        else:
+            uoffsets, ucand = self.base_index.within(xa, radius)
+        ucounts = np.diff(uoffsets)
+        mcounts = np.diff(self.moffsets)[ucand]
+        # Gather the members of every tied unique point at once
+        sel = _ExpandBlocks(self.moffsets[ucand], mcounts)
+        cand = self.members[sel]
+        share = self.shares[sel]
+        urows = np.repeat(np.arange(len(ucounts)), ucounts)
+        counts = np.bincount(urows, weights=mcounts,
+                             minlength=len(ucounts)).astype(np.int64)
+        offsets = np.zeros(len(ucounts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        multi = np.flatnonzero(ucounts > 1)
+        if len(multi) > 0:
+            # Restore the SCF order for rows tied with several points
+            esel = _ExpandBlocks(offsets[multi], counts[multi])
+            erows = np.repeat(np.arange(len(multi)), counts[multi])
+            cand[esel] = cand[esel][np.lexsort((cand[esel], erows))]
+        return offsets, cand, share, multi
+
+    def ties(self, xa):
+        """
+        For each row of xa, finds every SCF record at the minimum distance.
+        Returns the ties in CSR form as (offsets, cand).
+        """
+        offsets, cand, share, multi = self._Expand(xa)
+        return offsets, cand
+
+    def nearest(self, xa, k):
+        """
+        For each row of xa, finds the k nearest SCF records (all of them if
+        there are fewer), with records at the same distance taken in SCF
+        order, as NearestIndex.nearest does. Returns (dist, cand), both
+        arrays with a row for each row of xa, ordered by distance and then
+        SCF position.
+        """
+        xa = np.asarray(xa, dtype=np.float64)
+        if xa.ndim == 1:
+            xa = xa[:, np.newaxis]
+        k = min(k, self.size)
+        n = len(xa)
+        # The k nearest unique points have at least k members. Take members
+        # from each point in turn until there are k; the kth is a member of
+        # the point at which they reach k
+        udist, ucand = self.base_index.nearest(xa, k + 1)
+        mcounts = np.diff(self.moffsets)
+        counts = mcounts[ucand]
+        before = np.cumsum(counts, axis=1) - counts
+        reach = np.argmax(before + counts >= k, axis=1)
+        take = np.clip(k - before, 0, counts)
+        take[np.arange(udist.shape[1]) > reach[:, np.newaxis]] = 0
+        cand = self.members[_ExpandBlocks(self.moffsets[ucand.reshape(-1)],
+                                          take.reshape(-1))].reshape(n, k)
+        dist, cand = _SortRows(
+            np.repeat(udist.reshape(-1), take.reshape(-1)).reshape(n, k),
+            cand)
+        # Another point at the same distance as that one, before or after
+        # it, may have members earlier in SCF order
+        kth = udist[np.arange(n), reach]
+        other = np.arange(udist.shape[1]) != reach[:, np.newaxis]
+        tied = np.flatnonzero(np.any(
+            other & (np.abs(udist - kth[:, np.newaxis]) <=
+                     kth[:, np.newaxis] * 1e-8 + 1e-10), axis=1))
+        if len(tied) > 0:
+            # Every record at or within the kth distance, from which the k
+            # are taken in SCF order
+            xt = xa[tied]
+            uoffsets, ucand = self.base_index.within(xt, kth[tied])
+            urows = np.repeat(np.arange(len(tied)), np.diff(uoffsets))
+            udist = self.base_index.distance(xt[urows], ucand)
+            # Only the first k members of a point, in SCF order, can be taken
+            counts = np.minimum(mcounts[ucand], k)
+            tcand = self.members[_ExpandBlocks(self.moffsets[ucand], counts)]
+            dist[tied], cand[tied] = _NearestK(
+                np.repeat(urows, counts), np.repeat(udist, counts), tcand,
+                len(tied), k)
+        return dist, cand
+
+    def count_within(self, xa, radius):
+        """
+        For each row of xa, returns the number of SCF records within the
+        distance radius, or a slight overcount.
+        """
+        xa = np.asarray(xa, dtype=np.float64)
+        if xa.ndim == 1:
+            xa = xa[:, np.newaxis]
+        ucounts = self.base_index.count_within(xa, radius)
+        mcounts = np.diff(self.moffsets)
+        counts = np.zeros(len(xa), dtype=np.int64)
+        limit = max(1, int(self.mem_budget // PAIR_BYTES))
+        for start, stop in _Batches(ucounts, limit):
+            uoffsets, ucand = self.base_index.within(xa[start:stop], radius)
+            urows = np.repeat(np.arange(stop - start), np.diff(uoffsets))
+            counts[start:stop] = np.bincount(urows, weights=mcounts[ucand],
+                                             minlength=stop - start)
+        return counts
+
+    def within(self, xa, radius):
+        """
+        For each row of xa, finds every SCF record within the distance radius.
+        Returns them in CSR form as (offsets, cand).
+        """
+        offsets, cand, share, multi = self._Expand(xa, radius)
+        return offsets, cand
+
+    def split(self, xa, awt, radius=None):
+        """
+        Splits the weight of each PUF record across its tied SCF records, or
+        the SCF records within the distance radius if it is given, based on
+        the relative SCF weights, using the precomputed weight shares.
+        Returns the PUF position, SCF position and weight of each matching.
+        """
+        offsets, cand, share, multi = self._Expand(xa, radius)
+        counts = np.diff(offsets)
+        rows = np.repeat(np.arange(len(counts)), counts)
+        if len(multi) > 0:
+            # Shares across several unique points are recomputed
+            esel = _ExpandBlocks(offsets[multi], counts[multi])
+            sub = np.zeros(len(multi) + 1, dtype=np.int64)
+            np.cumsum(counts[multi], out=sub[1:])
+            wgts = self.mwgt[cand[esel]]
+            totals = _SegmentSum(wgts, sub)
+            share[esel] = wgts / np.repeat(totals, counts[multi])
+        wt = np.asarray(awt, dtype=np.float64)[rows] * share
+        return rows, cand, wt
+
+
+def SplitTies(offsets, cand, awt, mwgt):
+    """
+    Splits the weight of each PUF record across its tied SCF records based on
+    the relative SCF weights. Returns the PUF position, SCF position and
+    weight of each matching.
+    """
+    counts = np.diff(offsets)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    wgts = np.asarray(mwgt, dtype=np.float64)[cand]
+    totals = _SegmentSum(wgts, offsets)
+    wt = np.asarray(awt, dtype=np.float64)[rows] * wgts / totals[rows]
+    return rows, cand, wt
+
+
+def SplitReplicates(rows, wt, mwgt, repwgt, matched, mem_budget=2**30):
+    """
+    Splits the weight of each PUF record across the same SCF records again,
+    once for each set of SCF replicate weights. rows holds the PUF position
+    of each matching, in order, and wt its weight, split in proportion to
+    the SCF weight mwgt of its SCF record, possibly times a factor such as a
+    kernel of the distance. repwgt holds the replicate weights of the SCF
+    records, one column per replicate, and matched the row of repwgt of the
+    SCF record of each matching. All of the replicates are split at once, as
+    operations on a matrix. A PUF record whose SCF records all have zero
+    weight in a replicate keeps its split on the full-sample weights in that
+    replicate.
+
+    This is a generator: it yields matrices of weights, with a row for each
+    matching and a column for each replicate, for consecutive chunks of the
+    matchings. A chunk holds the matchings of whole PUF records, as many as
+    fit in mem_budget bytes at REPLICATE_BYTES per weight, or those of a
+    single PUF record with more matchings than that.
+    """
+    rows = np.asarray(rows)
+    wt = np.asarray(wt, dtype=np.float64)
+    mwgt = np.asarray(mwgt, dtype=np.float64)
+    matched = np.asarray(matched)
+    if len(rows) == 0:
+        return
+    starts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+    counts = np.diff(np.append(starts, len(rows)))
+    # The factor of each matching other than the SCF weight is the same for
+    # every replicate
+    factor = np.divide(wt, mwgt, out=np.zeros_like(wt), where=mwgt > 0)
+    limit = max(1, int(mem_budget // (REPLICATE_BYTES * repwgt.shape[1])))
+    for first, last in _Batches(counts, limit):
+        lo = starts[first]
+        hi = lo + int(counts[first:last].sum())
+        cstarts = starts[first:last] - lo
+        run = np.repeat(np.arange(last - first), counts[first:last])
+        awt = np.add.reduceat(wt[lo:hi], cstarts)
+        weights = np.array(repwgt[matched[lo:hi]], dtype=np.float64)
+        weights *= factor[lo:hi, np.newaxis]
+        # The totals are only kept for each PUF record
+        totals = np.add.reduceat(weights, cstarts, axis=0)
+        lost = totals <= 0
+        if np.any(lost):
+            fill = lost[run]
+            weights[fill] = np.broadcast_to(wt[lo:hi, np.newaxis],
+                                            fill.shape)[fill]
+            totals[lost] = np.broadcast_to(awt[:, np.newaxis],
+                                           lost.shape)[lost]
+        scale = np.divide(awt[:, np.newaxis], totals,
+                          out=np.zeros_like(totals), where=totals > 0)
+        weights *= scale[run]
+        yield weights
+
+
+def DrawTies(offsets, cand, mwgt, rng=None):
+    """
+    Randomly selects one tied SCF record for each PUF record, with selection
+    probabilities proportional to the SCF weights. The draws are taken from
+    the numpy Generator rng, one uniform number per PUF record in order, so
+    drawing for a set of PUF records in several blocks gives the same
+    selections as drawing for all of them at once. Returns the SCF position
+    selected for each PUF record.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    counts = np.diff(offsets)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    wgts = np.asarray(mwgt, dtype=np.float64)[cand]
+    # The cumulative weight within each block, as a fraction of the block
+    # total, is offset by the row number, so that the draws for every block
+    # can be found with a single search
+    cumwgt = np.cumsum(wgts)
+    base = np.repeat(cumwgt[offsets[:-1]] - wgts[offsets[:-1]], counts)
+    totals = _SegmentSum(wgts, offsets)
+    key = rows + (cumwgt - base) / totals[rows]
+    target = np.arange(len(counts)) + rng.random(len(counts))
+    pick = np.searchsorted(key, target, side='right')
+    pick = np.clip(pick, offsets[:-1], offsets[1:] - 1)
+    return cand[pick]
+
+
+def MatchKernelArrays(index, xa, awt, mwgt, k=NEIGHBOURS, kernel=KERNEL):
+    """
+    Matches each PUF point in xa to its k nearest SCF points in index, which
+    must provide nearest(xa, k), with records at the same distance taken in
+    SCF order, so every index gives the same matchings. The PUF weight awt is
+    split across them in proportion to the SCF weight mwgt times the kernel
+    of the distance divided by the bandwidth, the distance to the (k+1)th
+    nearest SCF record (or the farthest of the k, if there are only k).
+    Records at the bandwidth get no weight from the triangular and
+    Epanechnikov kernels. When all k are at the bandwidth, which happens when
+    more than k SCF records are tied at the kth distance, the weight is split
+    by the SCF weights alone, as with the uniform kernel. Returns the PUF
+    position, SCF position and weight of each matching, at most k per PUF
+    record, in SCF order within each PUF record.
+    """
+    awt = np.asarray(awt, dtype=np.float64)
+    mwgt = np.asarray(mwgt, dtype=np.float64)
+    n = len(awt)
+    dist, cand = index.nearest(xa, k + 1)
+    if dist.shape[1] > k:
+        # Set the (k+1)th nearest aside as the bandwidth
+        bandwidth = dist[:, k]
+        dist = dist[:, :k]
+        cand = cand[:, :k]
+    else:
+        bandwidth = dist.max(axis=1, initial=0.)
+    # Order the records of each PUF record by SCF position
+    order = np.argsort(cand, axis=1, kind='mergesort')
+    dist = np.take_along_axis(dist, order, axis=1)
+    cand = np.take_along_axis(cand, order, axis=1)
+    ratio = np.divide(dist, bandwidth[:, np.newaxis],
+                      out=np.zeros_like(dist),
+                      where=bandwidth[:, np.newaxis] > 0)
+    wgts = KERNELS[kernel](ratio) * mwgt[cand]
+    totals = wgts.sum(axis=1)
+    none = totals <= 0
+    if np.any(none):
+        wgts[none] = mwgt[cand[none]]
+        totals[none] = wgts[none].sum(axis=1)
+    wt = awt[:, np.newaxis] * wgts / totals[:, np.newaxis]
+    used = wt > 0
+    rows = np.repeat(np.arange(n), np.count_nonzero(used, axis=1))
+    return rows, cand[used], wt[used]
+
+
+def MatchCaliperArrays(index, xa, awt, mwgt, radius, max_matches=MAX_MATCHES,
+                       mem_budget=2**30):
+    """
+    Matches each PUF point in xa to every SCF point in index within the
+    distance radius, which index must support with count_within(xa, radius)
+    and within(xa, radius), or to the max_matches nearest of them if there
+    are more. The PUF weights awt are split across them based on the SCF
+    weights mwgt. PUF records with no SCF record within the radius are left
+    out. The SCF records within the radius are counted first, and the PUF
+    records are matched in batches of about mem_budget / PAIR_BYTES pairs,
+    so the working memory stays within mem_budget however wide the radius.
+    Returns the PUF position, SCF position and weight of each matching, in
+    PUF order and in SCF order within each PUF record.
+    """
+    xa = np.asarray(xa, dtype=np.float64)
+    if xa.ndim == 1:
+        xa = xa[:, np.newaxis]
+    awt = np.asarray(awt, dtype=np.float64)
+    limit = max(1, int(mem_budget // PAIR_BYTES))
+    counts = index.count_within(xa, radius)
+    pieces = [(np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0))]
+    under = np.flatnonzero((counts > 0) & (counts <= max_matches))
+    for start, stop in _Batches(counts[under], limit):
+        sel = under[start:stop]
+        if isinstance(index, CompressedIndex):
+            rows, cand, wt = index.split(xa[sel], awt[sel], radius)
+        else:
+            offsets, cand = index.within(xa[sel], radius)
+            rows, cand, wt = SplitTies(offsets, cand, awt[sel], mwgt)
+        pieces.append((sel[rows], cand, wt))
+    # The nearest max_matches SCF records of the others are all within the
+    # radius, unless the count was over
+    over = np.flatnonzero(counts > max_matches)
+    step = max(1, limit // max_matches)
+    for start in range(0, len(over), step):
+        sel = over[start:start + step]
+        dist, cand = index.nearest(xa[sel], max_matches)
+        order = np.argsort(cand, axis=1, kind='mergesort')
+        dist = np.take_along_axis(dist, order, axis=1)
+        cand = np.take_along_axis(cand, order, axis=1)
+        keep = dist <= radius
+        offsets = np.zeros(len(sel) + 1, dtype=np.int64)
+        np.cumsum(np.count_nonzero(keep, axis=1), out=offsets[1:])
+        rows, cand, wt = SplitTies(offsets, cand[keep], awt[sel], mwgt)
+        pieces.append((sel[rows], cand, wt))
+    rows, cand, wt = [np.concatenate(arrs) for arrs in zip(*pieces)]
+    order = np.argsort(rows, kind='mergesort')
+    return rows[order], cand[order], wt[order]
+
+
+def MatchNearestArrays(index, xa, awt, mwgt, ties='split', rng=None):
+    """
+    Matches the PUF points xa to the SCF points in index. With ties='split',
+    the PUF weights awt are split across all tied SCF records based on the SCF
+    weights mwgt; with ties='random', one tied SCF record is selected at
+    random using the numpy Generator rng. Returns the PUF position, SCF
+    position and weight of each matching.
+    """
+    assert ties in ['split', 'random']
+    if ties == 'split' and isinstance(index, CompressedIndex):
+        return index.split(xa, awt)
+    offsets, cand = index.ties(xa)
+    if ties == 'split':
+        return SplitTies(offsets, cand, awt, mwgt)
+    picks = DrawTies(offsets, cand, mwgt, rng)
+    return np.arange(len(picks)), picks, np.asarray(awt, dtype=np.float64)
@@ -0,0 +1,284 @@
+"""
+This file writes the results of the matching. Rather than collecting every
+matching in memory and writing them all at the end, the matchings are copied
+into preallocated buffers as they are produced and written out in batches of
+a fixed number of rows, so memory use does not grow with the size of the
+output.
+
+Results can be written as CSV (MatchWriter) or in a binary columnar format
+(BinaryMatchWriter). The binary file starts with the 8 bytes MAGIC, then the
+length of a JSON header as a little-endian 64-bit integer, then the header
+itself. The header holds the variant specification, hashes of the inputs, the
+number of rows and the data type and offset of each column, measured from the
+first multiple of 64 bytes after the header. Each column is stored as one
+contiguous array, aligned to 64 bytes, so LoadMatches can memory-map the
+columns without copying them.
+
+The weights of the matchings under each SCF replicate weight, when requested,
+are written alongside by ReplicateWriter as a matrix in a .npy file.
+"""
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# Number of rows held in memory before they are written out
+BATCH_ROWS = 2**20
+
+COLUMNS = [('pufseq', np.int64), ('scf_seq', np.int64), ('wgt', np.float64)]
+
+# Columns for the PUF records left unmatched by caliper matching
+UNMATCHED_COLUMNS = [('pufseq', np.int64), ('wgt', np.float64)]
+
+MAGIC = b'PUFSCFM1'
+ALIGN = 64
+
+
+def _Aligned(nbytes):
+    """
+    Rounds nbytes up to a multiple of ALIGN.
+    """
+    return -(-nbytes // ALIGN) * ALIGN
+
+
+class _BatchWriter(object):
+    """
+    Collects matchings into preallocated buffers and hands them to
+    _WriteBatch in batches of batch_rows rows.
+    """
+
+    def __init__(self, columns, batch_rows=BATCH_ROWS, implicates=False):
+        self.batch_rows = batch_rows
+        self.columns = list(columns)
+        if implicates:
+            self.columns.append(('implicate', np.int8))
+        self.buffers = [np.empty(batch_rows, dtype=dtype)
+                        for name, dtype in self.columns]
+        self.used = 0
+        self.rows = 0
+
+    def write(self, *arrays):
+        """
+        Adds matchings, given as one array per column.
+        """
+        assert len(arrays) == len(self.columns)
+        total = len(arrays[0])
+        start = 0
+        while start < total:
+            n = min(total - start, self.batch_rows - self.used)
+            for buf, arr in zip(self.buffers, arrays):
+                buf[self.used:self.used + n] = arr[start:start + n]
+            self.used += n
+            start += n
+            if self.used == self.batch_rows:
+                self.flush()
+
+    def flush(self):
+        """
+        Writes out the buffered matchings.
+        """
+        if self.used > 0:
+            self._WriteBatch([buf[:self.used] for buf in self.buffers])
+            self.rows += self.used
+            self.used = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MatchWriter(_BatchWriter):
+    """
+    Writes matchings to a CSV file in batches of batch_rows rows, in the same
+    format as the matching programs: the columns pufseq, scf_seq and wgt, with
+    the weights rounded to 2 decimals. With implicates, an implicate column is
+    added. Other columns, such as UNMATCHED_COLUMNS, can be given as columns.
+    """
+
+    def __init__(self, path, batch_rows=BATCH_ROWS, implicates=False,
+                 columns=COLUMNS):
+        _BatchWriter.__init__(self, columns, batch_rows, implicates)
+        self.path = path
+        self.file = open(path, 'w', newline='')
+        self.header = True
+
+    def _WriteBatch(self, arrays):
+        batch = pd.DataFrame({name: arr for (name, dtype), arr
+                              in zip(self.columns, arrays)})
+        batch.round(2).to_csv(self.file, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        """
+        Writes out any remaining matchings and closes the file.
+        """
+        if not self.file.closed:
+            self.flush()
+            if self.header:
+                self._WriteBatch([buf[:0] for buf in self.buffers])
+            self.file.close()
+
+
+class BinaryMatchWriter(_BatchWriter):
+    """
+    Writes matchings to a binary columnar file, with the PUF and SCF ids
+    stored as 32-bit integers and the weights as wgt_dtype (float32 or
+    float64). The weights are not rounded. The dictionary info, such as the
+    variant specification and input hashes, is saved in the header. Each
+    column is written to its own temporary file as the batches arrive, and
+    the columns are joined into the final file by close().
+    """
+
+    def __init__(self, path, info=None, wgt_dtype=np.float64,
+                 batch_rows=BATCH_ROWS, implicates=False):
+        assert np.dtype(wgt_dtype) in [np.float32, np.float64]
+        columns = [('pufseq', np.int32), ('scf_seq', np.int32),
+                   ('wgt', wgt_dtype)]
+        _BatchWriter.__init__(self, columns, batch_rows, implicates)
+        self.path = path
+        self.info = dict(info or {})
+        self.col_paths = [path + '.' + name + '.tmp'
+                          for name, dtype in self.columns]
+        self.col_files = [open(col_path, 'wb')
+                          for col_path in self.col_paths]
+
+    def write(self, *arrays):
+        """
+        Adds matchings, given as one array per column. The ids must fit in
+        32-bit integers.
+        """
+        limit = np.iinfo(np.int32)
+        for arr in arrays[:2]:
+            if len(arr) > 0 and (arr.min() < limit.min or
+                                 arr.max() > limit.max):
+                raise ValueError('ids do not fit in 32-bit integers')
+        _BatchWriter.write(self, *arrays)
+
+    def _WriteBatch(self, arrays):
+        for f, arr in zip(self.col_files, arrays):
+            f.write(np.ascontiguousarray(arr).tobytes())
+
+    def close(self):
+        """
+        Writes out any remaining matchings and joins the columns into the
+        final file.
+        """
+        if self.col_files[0].closed:
+            return
+        self.flush()
+        for f in self.col_files:
+            f.close()
+        # Column offsets are measured from the start of the data, which is
+        # the first aligned position after the header
+        columns = list()
+        offset = 0
+        for name, dtype in self.columns:
+            columns.append({'name': name, 'dtype': np.dtype(dtype).str,
+                            'offset': offset})
+            offset += _Aligned(self.rows * np.dtype(dtype).itemsize)
+        header = dict(self.info)
+        header['rows'] = self.rows
+        header['columns'] = columns
+        text = json.dumps(header).encode()
+        start = _Aligned(len(MAGIC) + 8 + len(text))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.array(len(text), dtype='<u8').tobytes())
+            f.write(text)
+            for col, col_path in zip(columns, self.col_paths):
+                f.write(b'\0' * (start + col['offset'] - f.tell()))
+                with open(col_path, 'rb') as cf:
+                    shutil.copyfileobj(cf, f)
+                os.remove(col_path)
+        os.replace(tmp_path, self.path)
+
+
+class ReplicateWriter(object):
+    """
+    Writes the replicate weights of the matchings, a matrix with a row for
+    each matching, in the order written by the match writers, and a column for
+    each replicate, as a .npy file of type dtype that np.load can memory-map.
+    The rows are written to a temporary file as they arrive, and close()
+    adds the header once the number of rows is known.
+    """
+
+    def __init__(self, path, replicates, dtype=np.float64):
+        self.path = path
+        self.replicates = replicates
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self.tmp_path = path + '.rows.tmp'
+        self.file = open(self.tmp_path, 'wb')
+
+    def write(self, weights):
+        """
+        Adds the replicate weights of a piece of matchings.
+        """
+        assert weights.shape[1] == self.replicates
+        self.file.write(np.ascontiguousarray(weights,
+                                             dtype=self.dtype).tobytes())
+        self.rows += len(weights)
+
+    def close(self):
+        """
+        Writes the .npy header and the rows to the final file.
+        """
+        if self.file.closed:
+            return
+        self.file.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.lib.format.write_array_header_1_0(
+                f, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                    'fortran_order': False,
+                    'shape': (self.rows, self.replicates)})
+            with open(self.tmp_path, 'rb') as rf:
+                shutil.copyfileobj(rf, f)
+        os.remove(self.tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def LoadMatches(path):
+    """
+    Memory-maps a file written by BinaryMatchWriter. Returns the header and a
+    dictionary of the columns as read-only arrays backed by the file.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a binary match file')
+        length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(length).decode())
+    start = _Aligned(len(MAGIC) + 8 + length)
+    columns = dict()
+    for col in header['columns']:
+        dtype = np.dtype(col['dtype'])
+        if header['rows'] == 0:
+            columns[col['name']] = np.zeros(0, dtype=dtype)
+        else:
+            columns[col['name']] = np.memmap(path, dtype=dtype, mode='r',
+                                             offset=start + col['offset'],
+                                             shape=(header['rows'],))
+    return header, columns
+
+
+def ExportCSV(path, csv_path, batch_rows=BATCH_ROWS):
+    """
+    Converts a binary match file to CSV in the format of MatchWriter.
+    """
+    header, columns = LoadMatches(path)
+    names = [col['name'] for col in header['columns']]
+    with MatchWriter(csv_path, batch_rows,
+                     implicates='implicate' in names) as writer:
+        for start in range(0, header['rows'], batch_rows):
+            writer.write(*[columns[name][start:start + batch_rows]
+                           for name in names])
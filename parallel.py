@@ -0,0 +1,94 @@
+"""
+This file runs independent pieces of the matching, such as the strata of a
+stratified variant, in a pool of worker processes. The input arrays for every
+task are copied once into a single block of shared memory, and each worker
+reads its arrays from there instead of receiving pickled copies. Results are
+returned in the order the tasks were given, whatever order the workers finish
+in.
+"""
+import concurrent.futures
+from multiprocessing import shared_memory
+import numpy as np
+
+# Arrays are placed on 64-byte boundaries within the shared block
+ALIGN = 64
+
+
+def _Layout(tasks):
+    """
+    Assigns each array in each task a position in the shared block. An array
+    object used by several tasks is only stored once. Returns the total size
+    and, for each task, a list of (offset, shape, dtype).
+    """
+    size = 0
+    layout = list()
+    placed = dict()
+    for arrays in tasks:
+        entries = list()
+        for arr in arrays:
+            if id(arr) not in placed:
+                nbytes = np.asarray(arr).nbytes
+                placed[id(arr)] = (size, np.shape(arr),
+                                   np.asarray(arr).dtype.str)
+                size += -(-nbytes // ALIGN) * ALIGN
+            entries.append(placed[id(arr)])
+        layout.append(entries)
+    return max(size, 1), layout
+
+
+def _RunTask(func, shm_name, entries, kwargs):
+    """
+    Attaches to the shared block, calls func on the arrays of one task and
+    returns copies of the results.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        arrays = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf,
+                             offset=offset)
+                  for offset, shape, dtype in entries]
+        for arr in arrays:
+            arr.flags.writeable = False
+        results = [np.array(res) for res in func(*arrays, **kwargs)]
+        del arrays
+    finally:
+        shm.close()
+    return results
+
+
+def MapShared(func, tasks, workers, task_kwargs=None, **kwargs):
+    """
+    Calls func(*arrays, **kwargs) for each tuple of arrays in tasks, using up
+    to workers processes. Arguments that differ between tasks, such as random
+    number generators, can be given in task_kwargs as one dictionary per task.
+    func must be a module-level function returning a tuple of arrays. Returns
+    the results in the order of tasks.
+    """
+    size, layout = _Layout(tasks)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        copied = set()
+        for arrays, entries in zip(tasks, layout):
+            for arr, (offset, shape, dtype) in zip(arrays, entries):
+                if offset in copied:
+                    continue
+                view = np.ndarray(shape, dtype=np.dtype(dtype),
+                                  buffer=shm.buf, offset=offset)
+                view[...] = arr
+                del view
+                copied.add(offset)
+        # Start the largest tasks first so they do not finish last
+        sizes = [sum(np.asarray(arr).nbytes for arr in arrays)
+                 for arrays in tasks]
+        futures = [None] * len(tasks)
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            for t in np.argsort(sizes, kind='mergesort')[::-1]:
+                targs = dict(kwargs)
+                if task_kwargs is not None:
+                    targs.update(task_kwargs[t])
+                futures[t] = pool.submit(_RunTask, func, shm.name, layout[t],
+                                         targs)
+            results = [future.result() for future in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+    return results
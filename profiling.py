@@ -0,0 +1,145 @@
+"""
+This file records where the time goes in a matching run. A RunReport keeps
+nested stage timers, counters and, optionally, cProfile statistics for chosen
+stages, and saves them as a JSON report. For example,
+    report = RunReport(profile=True)
+    with report.stage('load'):
+        with report.stage('scf'):
+            scf = pd.read_csv(scf_path)
+        report.count('scf_records', len(scf))
+    with report.stage('match', profile=True):
+        ...
+    report.write('match_report.json')
+records the times of the stages load, load/scf and match, the counter
+load/scf_records, and a profile of the match stage. A stage entered several
+times, such as one timed around each block of a streamed computation,
+accumulates its time, its number of calls and its profile.
+"""
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import platform
+import pstats
+import time
+import numpy as np
+
+# Number of functions listed for each profiled stage in the JSON report
+PROFILE_TOP = 30
+
+
+class RunReport(object):
+    """
+    Collects stage times, counters and profiles for one run. Stages are named
+    by their path, with nested stage names joined by '/'. Counters are
+    recorded under the path of the stage they are counted in. Stages entered
+    with profile=True are profiled only when the report was created with
+    profile=True.
+    """
+
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.info = dict()
+        self._path = list()
+        self._profilers = collections.OrderedDict()
+
+    def _Key(self, name):
+        return '/'.join(self._path + [name])
+
+    @contextlib.contextmanager
+    def stage(self, name, profile=False):
+        """
+        Times the enclosed code as the stage name, nested within the stage
+        currently running.
+        """
+        key = self._Key(name)
+        self._path.append(name)
+        profiler = None
+        if profile and self.profile:
+            if key not in self._profilers:
+                self._profilers[key] = cProfile.Profile()
+            profiler = self._profilers[key]
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+            self._path.pop()
+            entry = self.stages.setdefault(key, {'seconds': 0., 'calls': 0})
+            entry['seconds'] += elapsed
+            entry['calls'] += 1
+
+    def count(self, name, n=1):
+        """
+        Adds n to the counter name within the stage currently running.
+        """
+        key = self._Key(name)
+        self.counters[key] = self.counters.get(key, 0) + int(n)
+
+    def merge(self, other):
+        """
+        Adds the stage times and counters of another report, such as one kept
+        by a background worker, within the stage currently running.
+        """
+        for key, entry in other.stages.items():
+            mine = self.stages.setdefault(self._Key(key),
+                                          {'seconds': 0., 'calls': 0})
+            mine['seconds'] += entry['seconds']
+            mine['calls'] += entry['calls']
+        for key, n in other.counters.items():
+            self.counters[self._Key(key)] = (self.counters.get(self._Key(key),
+                                                               0) + n)
+
+    def _TopFunctions(self, profiler):
+        """
+        Returns the PROFILE_TOP functions of a profile with the most
+        cumulative time.
+        """
+        stats = pstats.Stats(profiler).stats
+        rows = sorted(stats.items(), key=lambda item: -item[1][3])
+        top = list()
+        for (fname, line, func), (cc, nc, tt, ct, callers) in \
+                rows[:PROFILE_TOP]:
+            top.append({'function': '{}:{}({})'.format(fname, line, func),
+                        'calls': nc, 'tottime': tt, 'cumtime': ct})
+        return top
+
+    def as_dict(self):
+        """
+        Returns the report as a dictionary that can be saved as JSON.
+        """
+        report = {'python': platform.python_version(),
+                  'numpy': np.__version__,
+                  'cpus': os.cpu_count()}
+        report.update(self.info)
+        report['stages'] = dict(self.stages)
+        report['counters'] = dict(self.counters)
+        if self._profilers:
+            report['profiles'] = {key: self._TopFunctions(profiler)
+                                  for key, profiler
+                                  in self._profilers.items()}
+        return report
+
+    def write(self, path):
+        """
+        Saves the report as JSON. The full statistics of each profiled stage
+        are also saved in the format of the pstats module, next to the
+        report, with names made from the report name and the stage path.
+        """
+        report = self.as_dict()
+        base = os.path.splitext(path)[0]
+        files = dict()
+        for key, profiler in self._profilers.items():
+            prof_path = base + '_' + key.replace('/', '_') + '.prof'
+            profiler.dump_stats(prof_path)
+            files[key] = os.path.basename(prof_path)
+        if files:
+            report['profile_files'] = files
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,164 @@
+"""
+This file caches the PUF extract used for matching. Building the extract
+requires reading puf.csv into taxcalc, aging it and running the calculator,
+only to pull out a handful of variables. The extracted variables are saved in
+a binary file so that later runs can load them directly, without importing
+taxcalc at all.
+
+A cached extract is identified by the contents of puf.csv, the installed
+taxcalc version, the year the PUF is aged to and the list of variables. If any
+of these change, the extract is rebuilt.
+
+Extracts for several years are built in one pass by LoadPUFYears: a single
+Calculator is advanced year by year and the variables are taken at each year
+requested, rather than reading and aging the PUF again from the start year
+for each one.
+"""
+import hashlib
+import json
+import os
+from importlib import metadata
+import numpy as np
+import pandas as pd
+from profiling import RunReport
+
+CUR_PATH = os.path.abspath(os.path.dirname(__file__))
+CACHE_DIR = os.path.join(CUR_PATH, 'cache')
+
+RECVARS = ['e00200', 'e02100', 'e00900', 'e02000', 'e00400', 'e00300',
+           'e00600', 'e02300', 'e01500', 'e02400', 'age_head', 's006',
+           'RECID', 'MARS']
+
+
+def _WriteAtomic(path, write):
+    """
+    Writes a file through a temporary file in the same directory, so that a
+    failed run never leaves a partial file behind.
+    """
+    tmp_path = path + '.tmp' + str(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def FileHash(path, cache_dir=CACHE_DIR):
+    """
+    Returns the SHA-256 hash of the contents of a file. Hashes are remembered
+    by file size and modification time, so an unchanged file is only read
+    once.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    index_path = os.path.join(cache_dir, 'hashes.json')
+    index = dict()
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    if path in index and index[path]['stamp'] == stamp:
+        return index[path]['sha256']
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    index[path] = {'stamp': stamp, 'sha256': sha.hexdigest()}
+    os.makedirs(cache_dir, exist_ok=True)
+    _WriteAtomic(index_path, lambda f: f.write(json.dumps(index).encode()))
+    return sha.hexdigest()
+
+
+def TaxcalcVersion():
+    """
+    Returns the installed taxcalc version without importing taxcalc.
+    """
+    try:
+        return metadata.version('taxcalc')
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def CacheKey(puf_path, year, recvars, cache_dir=CACHE_DIR):
+    """
+    Returns the key identifying a cached PUF extract.
+    """
+    spec = {'puf': FileHash(puf_path, cache_dir),
+            'taxcalc': TaxcalcVersion(),
+            'year': int(year),
+            'recvars': list(recvars)}
+    key = hashlib.sha256(json.dumps(spec, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+def AgePUFYears(puf_path, years, recvars, report=None):
+    """
+    Reads in the PUF, ages it with one taxcalc Calculator through each of
+    the given years in turn and returns a dictionary of the requested
+    variables at each year. Each step is timed in report, if given.
+    """
+    report = report or RunReport()
+    from taxcalc import Records, Policy, Calculator
+    with report.stage('read'):
+        recs = Records(puf_path)
+    pol = Policy()
+    calc = Calculator(policy=pol, records=recs, verbose=False)
+    extracts = dict()
+    for year in sorted(set(years)):
+        with report.stage('advance_to_year'):
+            calc.advance_to_year(year)
+        with report.stage('calc_all'):
+            calc.calc_all()
+        with report.stage('dataframe'):
+            extracts[year] = calc.dataframe(recvars)
+    return extracts
+
+
+def SaveExtract(path, puf):
+    """
+    Saves a PUF extract as a binary file with one array per variable.
+    """
+    arrays = {'col_' + name: np.array(puf[name]) for name in puf.columns}
+    arrays['columns'] = np.array(list(puf.columns))
+    _WriteAtomic(path, lambda f: np.savez(f, **arrays))
+
+
+def ReadExtract(path):
+    """
+    Reads a PUF extract saved with SaveExtract.
+    """
+    with np.load(path) as data:
+        columns = [str(name) for name in data['columns']]
+        puf = pd.DataFrame({name: data['col_' + name] for name in columns})
+    return puf
+
+
+def LoadPUFYears(puf_path='puf.csv', years=(2015,), recvars=RECVARS,
+                 cache_dir=CACHE_DIR, report=None):
+    """
+    Returns a dictionary of the PUF variables recvars aged to each of the
+    given years, reading them from the cache when possible. The years that
+    are not cached are aged together by AgePUFYears. The steps are timed in
+    report, if given.
+    """
+    report = report or RunReport()
+    paths = dict()
+    with report.stage('cache_key'):
+        for year in years:
+            key = CacheKey(puf_path, year, recvars, cache_dir)
+            paths[year] = os.path.join(cache_dir, 'puf_' + key[:24] + '.npz')
+    extracts = dict()
+    for year in years:
+        if os.path.exists(paths[year]):
+            report.count('cache_hits')
+            with report.stage('read_cache'):
+                extracts[year] = ReadExtract(paths[year])
+    missing = [year for year in years if year not in extracts]
+    if missing:
+        with report.stage('age'):
+            aged = AgePUFYears(puf_path, missing, recvars, report)
+        with report.stage('save_cache'):
+            os.makedirs(cache_dir, exist_ok=True)
+            for year in missing:
+                SaveExtract(paths[year], aged[year])
+        extracts.update(aged)
+    return extracts
+
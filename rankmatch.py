@@ -0,0 +1,145 @@
+"""
+This file holds the matching done by sorting on income (the 0x programs).
+Both datasets are sorted by income and the records are aligned by their
+cumulative weights, so that the weight of each PUF record is used up by the
+SCF records at the same rank.
+
+The pairings follow directly from the breakpoints of the two cumulative weight
+vectors: between any two neighbouring breakpoints, exactly one PUF record and
+one SCF record are active, and the length of the interval is the weight of
+their matching. RankMatch computes these in a few array passes. The original
+record-by-record loop is kept as RankMatchLegacy so that the two can be
+compared with CompareMatches.
+"""
+import numpy as np
+import pandas as pd
+
+
+def RankPairs(awt, bwt, epsilon=0.001):
+    """
+    Aligns two weight vectors that are already sorted by income. Returns the
+    position in awt, the position in bwt and the weight of each matching.
+    Intervals of weight epsilon or less are treated as rounding error and
+    dropped.
+    """
+    awt = np.asarray(awt, dtype=np.float64)
+    bwt = np.asarray(bwt, dtype=np.float64)
+    cuma = np.cumsum(awt)
+    cumb = np.cumsum(bwt)
+    # Merge the breakpoints of both cumulative weight vectors
+    points = np.concatenate(([0.], np.sort(np.concatenate((cuma, cumb)),
+                                            kind='mergesort')))
+    points = points[points <= cuma[-1]]
+    hi = points[1:]
+    wt = np.diff(points)
+    keep = wt > epsilon
+    hi = hi[keep]
+    wt = wt[keep]
+    # The records active on each interval
+    i = np.minimum(np.searchsorted(cuma, hi, side='left'), len(awt) - 1)
+    j = np.minimum(np.searchsorted(cumb, hi, side='left'), len(bwt) - 1)
+    return i, j, wt
+
+
+def RankMatchArrays(inca, awt, incb, bwt, epsilon=0.001):
+    """
+    Matches PUF records with incomes inca and weights awt to SCF records with
+    incomes incb and weights bwt by aligning the records sorted by income. The
+    SCF weights are first rescaled to the PUF total. Returns the PUF position,
+    SCF position and weight of each matching.
+    """
+    awt = np.asarray(awt, dtype=np.float64)
+    bwt = np.asarray(bwt, dtype=np.float64)
+    wt_factor = np.sum(awt) / np.sum(bwt)
+    pord = np.argsort(inca, kind='mergesort')
+    sord = np.argsort(incb, kind='mergesort')
+    i, j, wt = RankPairs(awt[pord], bwt[sord] * wt_factor, epsilon)
+    return pord[i], sord[j], wt
+
+
+def RankMatch(puf, scf, varname='compincome', epsilon=0.001):
+    """
+    This function takes in a PUF dataset and a SCF dataset and matches the
+    results by aligning the records sorted by varname. It returns a dataset of
+    pairings of PUF and SCF records and the weight accorded to each.
+    """
+    i, j, wt = RankMatchArrays(np.array(puf[varname]), np.array(puf['s006']),
+                               np.array(scf[varname]), np.array(scf['wgt']),
+                               epsilon)
+    match1 = pd.DataFrame({'pufseq': np.array(puf['RECID'])[i],
+                           'scf_seq': np.array(scf['Y1'])[j], 'wgt': wt})
+    return match1
+
+
+def RankMatchLegacy(puf, scf, varname='compincome', epsilon=0.001):
+    """
+    The original sort-and-align loop, which walks the PUF records and uses up
+    their weights one SCF record at a time. This is kept as a reference for
+    RankMatch.
+    """
+    wt_factor = np.sum(puf['s006']) / np.sum(scf['wgt'])
+    pord = np.argsort(np.array(puf[varname]), kind='mergesort')
+    sord = np.argsort(np.array(scf[varname]), kind='mergesort')
+    recid = np.array(puf['RECID'])[pord]
+    awt_all = np.array(puf['s006'])[pord]
+    y1 = np.array(scf['Y1'])[sord]
+    bwt_all = np.array(scf['wgt'])[sord] * wt_factor
+    puf_list = list()
+    scf_list = list()
+    wt_list = list()
+    j = 0
+    count = len(y1) - 1
+    bwt = bwt_all[0]
+    # Iterate over PUF observations
+    for i in range(len(recid)):
+        # Grab weight for PUF unit
+        awt = awt_all[i]
+        # Run until PUF record weight used up
+        while awt > epsilon:
+            # Stop once the last SCF record is used up; the original loop
+            # would not terminate here
+            if bwt <= 0:
+                break
+            # Append the matched records
+            puf_list.append(recid[i])
+            scf_list.append(y1[j])
+            # Use lesser weight for matched record
+            cwt = min(awt, bwt)
+            wt_list.append(cwt)
+            # Update remaining weights for records
+            awt = max(0, awt - cwt)
+            bwt = max(0, bwt - cwt)
+            # If SCF weight used up and SCF records not all used up
+            if bwt <= epsilon and j < count:
+                j += 1
+                bwt = bwt_all[j]
+    match1 = pd.DataFrame({'pufseq': puf_list, 'scf_seq': scf_list,
+                           'wgt': wt_list})
+    return match1
+
+
+def CompareMatches(new, old):
+    """
+    Summarizes how much two sets of matchings differ. Weight differences are
+    measured on the total weight of each (pufseq, scf_seq) pairing, on the
+    total weight of each PUF record and on the total weight of each SCF
+    record. Returns a dictionary of the results.
+    """
+    def _Diff(keys):
+        wnew = new.groupby(keys)['wgt'].sum()
+        wold = old.groupby(keys)['wgt'].sum()
+        diff = wnew.sub(wold, fill_value=0.).abs()
+        return diff
+
+    pair_diff = _Diff(['pufseq', 'scf_seq'])
+    puf_diff = _Diff('pufseq')
+    scf_diff = _Diff('scf_seq')
+    res = {'rows_new': len(new),
+           'rows_old': len(old),
+           'total_wgt_new': float(new['wgt'].sum()),
+           'total_wgt_old': float(old['wgt'].sum()),
+           'pairs_differing': int((pair_diff > 0.01).sum()),
+           'wgt_moved': float(pair_diff.sum() / 2.),
+           'max_puf_wgt_diff': float(puf_diff.max()),
+           'max_scf_wgt_diff': float(scf_diff.max())}
+    return res
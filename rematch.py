@@ -0,0 +1,105 @@
+"""
+This file keeps the results of earlier matching runs, so that after a change
+to the inputs, such as a revised PUF or SCF or a new aging year, only the
+parts of the matching whose inputs changed are redone.
+
+The matching is divided into units: a stratum of the SCF (or a stratum and
+implicate) against a block of PUF records in it. The blocks are cut after
+records chosen by a hash of their record ids (ContentBlocks), not at fixed
+positions, so dropping or adding PUF records only changes the blocks that held
+them rather than shifting every later block (except with random tie-breaking,
+whose draws for the later records of the stratum move too). Each unit is
+identified by a fingerprint of its inputs, the matching variables, weights and
+record ids of the SCF stratum and the PUF block, together with the variant and
+the settings that affect the results. The matchings of each unit are saved
+under that fingerprint, so a unit whose inputs are unchanged is loaded rather
+than matched again, and the search index of a stratum is only built when some
+of its units have to be matched.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+from puf_cache import CACHE_DIR, _WriteAtomic
+
+# Changing this invalidates all saved results, e.g. when the matching itself
+# changes
+VERSION = 1
+
+RESULTS_DIR = os.path.join(CACHE_DIR, 'results')
+
+
+def Fingerprint(*arrays):
+    """
+    Returns a SHA-256 hash of the types, shapes and contents of arrays.
+    """
+    sha = hashlib.sha256()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        sha.update(arr.dtype.str.encode())
+        sha.update(str(arr.shape).encode())
+        sha.update(arr.tobytes())
+    return sha.hexdigest()
+
+
+def ContentBlocks(ids, block_rows):
+    """
+    Cuts a run of records with the given ids into blocks of at most
+    block_rows records. A block ends after each record whose id hashes to
+    one of about 4 in block_rows values, so the boundaries move with the
+    records rather than with their positions, and otherwise after block_rows
+    records. Returns a list of (start, stop) positions.
+    """
+    ids = np.asarray(ids).astype(np.uint64)
+    period = np.uint64(max(1, block_rows // 4))
+    # Fibonacci hashing, keeping the well-mixed high bits
+    hashed = (ids * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+    ends = np.flatnonzero(hashed % period == 0) + 1
+    bounds = [0]
+    for end in list(ends) + [len(ids)]:
+        while end - bounds[-1] > block_rows:
+            bounds.append(bounds[-1] + block_rows)
+        if end > bounds[-1]:
+            bounds.append(int(end))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class ResultCache(object):
+    """
+    Saves and loads the matchings of units of the matching, given as the PUF
+    position within the unit, SCF position within the stratum and weight of
+    each matching. Results are kept until the directory is removed.
+    """
+
+    def __init__(self, cache_dir=RESULTS_DIR):
+        self.cache_dir = cache_dir
+
+    def key(self, spec, *fingerprints):
+        """
+        Returns the key of a unit from a dictionary spec describing the
+        variant and settings, and the fingerprints of its inputs.
+        """
+        text = json.dumps({'version': VERSION, 'spec': spec,
+                           'inputs': list(fingerprints)}, sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _Path(self, key):
+        return os.path.join(self.cache_dir, 'unit_' + key[:32] + '.npz')
+
+    def load(self, key):
+        """
+        Returns the saved (i, j, wt) of a unit, or None if there are none.
+        """
+        path = self._Path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as saved:
+            return saved['i'], saved['j'], saved['wt']
+
+    def save(self, key, i, j, wt):
+        """
+        Saves the matchings (i, j, wt) of a unit.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        _WriteAtomic(self._Path(key),
+                     lambda f: np.savez(f, i=i, j=j, wt=wt))
@@ -0,0 +1,239 @@
+"""
+This file prepares the SCF data for matching, in place of the Stata do file
+scf_prep.do. The comparable, active and passive income measures are built from
+the raw survey responses in p16i6.dta and merged with the age, marital status
+(married) and weight of each record from the summary extract rscfp2016.dta:
+    Active income: X5702 + X5704 + X5714
+                   (wages, sole proprietorship and farm income, Sch E income)
+    Passive income: X5706 + X5708 + X5710 + X5716 + X5722
+                   (interest, dividends, pensions and annuities, Social
+                    Security, Unemployment Insurance)
+    Comparable income: active income + passive income
+These are the same measures that scf_prep.do builds.
+
+Only the columns used are read from the two files, a chunk of rows at a time,
+so the full raw file, with several thousand variables, is never held in
+memory. The prepared extract is saved in the cache directory in the same
+binary format as the PUF extract, keyed by the contents of the two files, so
+later runs load it directly. For example,
+    python scf_prep.py --raw p16i6.dta --summary rscfp2016.dta
+saves the extract and writes scf.csv for the matching programs.
+
+The replicate weights of the SCF, used to estimate the variance of results
+from the matching, are read from the replicate weight file in the same way by
+LoadReplicates, and AlignReplicates lines them up with the SCF records.
+"""
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from puf_cache import CACHE_DIR, FileHash, SaveExtract, ReadExtract
+
+CUR_PATH = os.path.abspath(os.path.dirname(__file__))
+
+ACTIVE_VARS = ['X5702', 'X5704', 'X5714']
+PASSIVE_VARS = ['X5706', 'X5708', 'X5710', 'X5716', 'X5722']
+SUMMARY_VARS = ['Y1', 'age', 'married', 'wgt']
+SCF_VARS = ['Y1', 'compincome', 'activeincome', 'passiveincome', 'age',
+            'married', 'wgt']
+
+# Prefixes of the replicate weights and multiplicity factors in the SCF
+# replicate weight file (p16_rw1.dta); the replicate weight of a record is the
+# product of the two
+REPLICATE_VARS = ('WT1B', 'MM')
+
+# Number of rows read from the Stata files at a time
+CHUNK_ROWS = 10000
+
+# Changing this invalidates the cached extracts, e.g. when the measures change
+VERSION = 2
+
+
+def _StataVarlist(path):
+    """
+    Returns the names of the variables in a Stata file.
+    """
+    with pd.read_stata(path, iterator=True) as reader:
+        return list(reader.variable_labels())
+
+
+def _StataColumns(path, names):
+    """
+    Returns the names in a Stata file of the variables names, which are
+    matched without regard to case, since the raw and summary files do not
+    use the same case.
+    """
+    varlist = _StataVarlist(path)
+    lookup = {name.lower(): name for name in varlist}
+    missing = [name for name in names if name.lower() not in lookup]
+    if missing:
+        raise ValueError(path + ' is missing ' + ', '.join(missing))
+    return [lookup[name.lower()] for name in names]
+
+
+def ReadStata(path, names, chunk_rows=CHUNK_ROWS):
+    """
+    Reads the variables names from a Stata file, chunk_rows rows at a time,
+    and yields each chunk as a dictionary of float arrays keyed by names.
+    """
+    columns = _StataColumns(path, names)
+    chunks = pd.read_stata(path, columns=columns, chunksize=chunk_rows,
+                           convert_categoricals=False, convert_dates=False)
+    with chunks:
+        for chunk in chunks:
+            yield {name: chunk[col].to_numpy(dtype=np.float64)
+                   for name, col in zip(names, columns)}
+
+
+def IncomeMeasures(raw_path, chunk_rows=CHUNK_ROWS):
+    """
+    Computes the comparable, active and passive income of each record in the
+    raw SCF responses. Returns a DataFrame with Y1 and the three measures.
+    """
+    pieces = list()
+    for chunk in ReadStata(raw_path, ['Y1'] + ACTIVE_VARS + PASSIVE_VARS,
+                           chunk_rows):
+        active = np.sum([chunk[name] for name in ACTIVE_VARS], axis=0)
+        passive = np.sum([chunk[name] for name in PASSIVE_VARS], axis=0)
+        pieces.append(pd.DataFrame({'Y1': chunk['Y1'].astype(np.int64),
+                                    'compincome': active + passive,
+                                    'activeincome': active,
+                                    'passiveincome': passive}))
+    return pd.concat(pieces, ignore_index=True)
+
+
+def PrepSCF(raw_path, summary_path, chunk_rows=CHUNK_ROWS):
+    """
+    Builds the SCF extract used for matching, with the variables in
+    SCF_VARS, from the raw responses and the summary extract.
+    """
+    income = IncomeMeasures(raw_path, chunk_rows)
+    pieces = [pd.DataFrame({'Y1': chunk['Y1'].astype(np.int64),
+                            'age': chunk['age'],
+                            'married': chunk['married'],
+                            'wgt': chunk['wgt']})
+              for chunk in ReadStata(summary_path, SUMMARY_VARS, chunk_rows)]
+    summary = pd.concat(pieces, ignore_index=True)
+    scf = pd.merge(summary, income, on='Y1', how='outer', sort=False,
+                   validate='one_to_one')
+    return scf[SCF_VARS]
+
+
+def SCFKey(raw_path, summary_path, cache_dir=CACHE_DIR):
+    """
+    Returns the key identifying a cached SCF extract.
+    """
+    spec = {'raw': FileHash(raw_path, cache_dir),
+            'summary': FileHash(summary_path, cache_dir),
+            'version': VERSION}
+    key = hashlib.sha256(json.dumps(spec, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+def LoadSCF(raw_path='p16i6.dta', summary_path='rscfp2016.dta',
+            cache_dir=CACHE_DIR):
+    """
+    Returns the SCF extract used for matching, reading it from the cache when
+    possible.
+    """
+    key = SCFKey(raw_path, summary_path, cache_dir)
+    path = os.path.join(cache_dir, 'scf_' + key[:24] + '.npz')
+    if os.path.exists(path):
+        return ReadExtract(path)
+    scf = PrepSCF(raw_path, summary_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    SaveExtract(path, scf)
+    return scf
+
+
+def ReadReplicates(path, replicates=None, chunk_rows=CHUNK_ROWS):
+    """
+    Reads the replicate weights from the SCF replicate weight file, the
+    first replicates of them, or all by default. Returns a DataFrame with the
+    record id, Y1, or the household id, YY1, if the file has no Y1, and a
+    column rep<k> for each replicate.
+    """
+    varlist = [name.upper() for name in _StataVarlist(path)]
+    weight, factor = REPLICATE_VARS
+    count = 0
+    while (weight + str(count + 1) in varlist and
+           factor + str(count + 1) in varlist):
+        count += 1
+    if replicates is not None:
+        count = min(count, replicates)
+    if count == 0:
+        raise ValueError(path + ' has no replicate weights')
+    key = 'Y1' if 'Y1' in varlist else 'YY1'
+    weights = [weight + str(k + 1) for k in range(count)]
+    factors = [factor + str(k + 1) for k in range(count)]
+    pieces = list()
+    for chunk in ReadStata(path, [key] + weights + factors, chunk_rows):
+        table = np.column_stack([chunk[name] for name in weights])
+        table *= np.column_stack([chunk[name] for name in factors])
+        piece = pd.DataFrame(table, columns=['rep' + str(k + 1)
+                                             for k in range(count)])
+        piece.insert(0, key, chunk[key].astype(np.int64))
+        pieces.append(piece)
+    return pd.concat(pieces, ignore_index=True)
+
+
+def LoadReplicates(path, replicates=None, cache_dir=CACHE_DIR):
+    """
+    Returns the replicate weights read by ReadReplicates, reading them from
+    the cache when possible.
+    """
+    spec = {'replicates': FileHash(path, cache_dir), 'count': replicates,
+            'version': VERSION}
+    key = hashlib.sha256(json.dumps(spec, sort_keys=True).encode())
+    cache_path = os.path.join(cache_dir,
+                              'replicates_' + key.hexdigest()[:24] + '.npz')
+    if os.path.exists(cache_path):
+        return ReadExtract(cache_path)
+    table = ReadReplicates(path, replicates)
+    os.makedirs(cache_dir, exist_ok=True)
+    SaveExtract(cache_path, table)
+    return table
+
+
+def AlignReplicates(table, y1):
+    """
+    Returns the replicate weights in table, from LoadReplicates, of the SCF
+    records with ids y1, as a matrix with one column per replicate. The
+    weights are looked up by Y1, or by household (YY1, which is Y1 without
+    its last digit, the implicate) if table has no Y1.
+    """
+    y1 = np.asarray(y1, dtype=np.int64)
+    if 'Y1' in table.columns:
+        key, ids = 'Y1', y1
+    else:
+        key, ids = 'YY1', y1 // 10
+    rows = pd.Index(table[key]).get_indexer(ids)
+    if np.any(rows < 0):
+        raise ValueError('no replicate weights for ' +
+                         str(np.count_nonzero(rows < 0)) + ' SCF records')
+    return table.drop(columns=key).to_numpy(dtype=np.float64)[rows]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Prepare the SCF data for matching.')
+    parser.add_argument('--raw', default=os.path.join(CUR_PATH, 'p16i6.dta'),
+                        help='raw SCF responses (default: p16i6.dta)')
+    parser.add_argument('--summary',
+                        default=os.path.join(CUR_PATH, 'rscfp2016.dta'),
+                        help='SCF summary extract (default: rscfp2016.dta)')
+    parser.add_argument('--out', default=os.path.join(CUR_PATH, 'scf.csv'),
+                        help='file for the prepared data, CSV or .npz '
+                             '(default: scf.csv)')
+    args = parser.parse_args(argv)
+    scf = LoadSCF(args.raw, args.summary)
+    if args.out.endswith('.npz'):
+        SaveExtract(args.out, scf)
+    else:
+        scf.to_csv(args.out, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+This file divides the PUF and SCF records into strata, the groups of records
+that are only matched with each other. A stratification is made up of one or
+more dimensions, such as age groups (Bins) or marital status (Categories), and
+its strata are the cross-product of their categories; for example, the 6 age
+groups crossed with marital status give 12 strata.
+
+Rather than selecting the records of each stratum with a boolean mask, which
+scans every record once per stratum, each record is given the code of its
+stratum, in one pass over the variable of each dimension, and the records are
+grouped by a single stable sort of the codes (Group). The records of a stratum
+are then a contiguous run of the sorted order, still in their original order,
+and any variable put into that order once can be handed to the matching one
+stratum at a time as slices, without copying. For example,
+    strat = Stratification([Bins('age', [35, 45, 55, 65, 75]),
+                            Categories('married', [[2], [1]])])
+    codes = strat.codes('scf', [scf['age'], scf['married']])
+    order, offsets = Group(codes, strat.size)
+gives the SCF records of the stratum with key strat.keys()[g] as
+order[offsets[g]:offsets[g + 1]].
+"""
+import itertools
+import numpy as np
+
+
+class Bins(object):
+    """
+    A dimension dividing the values of varname at the cutoffs edges: values
+    below edges[0] are in category 0, values from edges[k - 1] up to edges[k]
+    in category k, and values from the last cutoff up in the last category.
+    """
+
+    def __init__(self, varname, edges):
+        self.varname = varname
+        self.edges = np.asarray(edges)
+        self.size = len(edges) + 1
+
+    def codes(self, side, values):
+        """
+        Returns the category of each value.
+        """
+        return np.digitize(np.asarray(values), self.edges)
+
+
+class Categories(object):
+    """
+    A dimension grouping the values of varname into categories. groups is a
+    list of the values in each category, or, when the PUF and SCF code the
+    variable differently, a dictionary of such lists for each side ('puf' and
+    'scf').
+    """
+
+    def __init__(self, varname, groups):
+        self.varname = varname
+        if not isinstance(groups, dict):
+            groups = {'puf': groups, 'scf': groups}
+        sizes = set(len(sgroups) for sgroups in groups.values())
+        if len(sizes) != 1:
+            raise ValueError(varname + ' has different categories by side')
+        self.size = sizes.pop()
+        # Sorted values and their categories, looked up by a binary search
+        self._lookup = dict()
+        for side, sgroups in groups.items():
+            values = np.concatenate([np.asarray(group, dtype=np.float64)
+                                     for group in sgroups])
+            cats = np.repeat(np.arange(self.size),
+                             [len(group) for group in sgroups])
+            order = np.argsort(values)
+            self._lookup[side] = (values[order], cats[order])
+
+    def codes(self, side, values):
+        """
+        Returns the category of each value. Values not in any category raise
+        a ValueError.
+        """
+        values = np.asarray(values)
+        known, cats = self._lookup[side]
+        pos = np.minimum(np.searchsorted(known, values), len(known) - 1)
+        bad = known[pos] != values
+        if np.any(bad):
+            raise ValueError('unknown {} values: {}'.format(
+                self.varname, np.unique(values[bad])[:10]))
+        return cats[pos]
+
+
+class Stratification(object):
+    """
+    The strata given by the cross-product of the categories of dimensions.
+    The code of a stratum combines the categories of its dimensions with the
+    first dimension varying slowest, so the strata sort in the order of
+    keys().
+    """
+
+    def __init__(self, dimensions):
+        self.dimensions = list(dimensions)
+        self.size = int(np.prod([dim.size for dim in self.dimensions]))
+
+    def keys(self):
+        """
+        Returns the key of each stratum in the order of their codes: the
+        category for a single dimension, or a tuple of the categories of
+        each dimension.
+        """
+        keys = itertools.product(*[range(dim.size)
+                                   for dim in self.dimensions])
+        if len(self.dimensions) == 1:
+            return [key[0] for key in keys]
+        return list(keys)
+
+    def codes(self, side, columns):
+        """
+        Returns the stratum code of each record, given the values of the
+        variable of each dimension in columns.
+        """
+        code = np.zeros(len(columns[0]), dtype=np.int64)
+        for dim, values in zip(self.dimensions, columns):
+            code *= dim.size
+            code += dim.codes(side, values)
+        return code
+
+
+def Group(codes, size):
+    """
+    Groups records by their codes, from 0 to size - 1, with one stable sort.
+    Returns (order, offsets), where the records with code g are
+    order[offsets[g]:offsets[g + 1]], in their original order.
+    """
+    if size == 1:
+        return np.arange(len(codes)), np.array([0, len(codes)])
+    # numpy sorts integers of 16 bits or less stably by radix sort, in
+    # linear time
+    codes = np.asarray(codes).astype(np.min_scalar_type(size - 1))
+    order = np.argsort(codes, kind='stable')
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=size), out=offsets[1:])
+    return order, offsets
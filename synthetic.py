@@ -0,0 +1,86 @@
+"""
+This file generates synthetic PUF and SCF datasets with the same variables as
+the prepared data used for matching, so the matching can be timed and checked
+without access to the PUF, the SCF files or a taxcalc aging run. The values
+are random and are not meant to resemble either dataset closely, but they
+share the features that matter for the speed of the matching:
+ - SCF households appear 5 times, once per implicate, with Y1 = 10 * YY1 + m
+ - SCF incomes are rounded, and many households report the same income in
+   every implicate, so there are many exact ties
+ - many records have no income of a given type
+The synthetic PUF has the taxcalc variables in puf_cache.RECVARS, so the
+income measures are computed by match.AddIncomeMeasures as for the real PUF.
+"""
+import numpy as np
+import pandas as pd
+
+# Share of SCF households whose reported income is the same in every
+# implicate
+SAME_SHARE = 0.6
+
+
+def _Income(rng, n, share, mean, sigma=1.):
+    """
+    Draws n lognormal incomes, of which about share are nonzero.
+    """
+    amount = rng.lognormal(np.log(mean), sigma, n)
+    return np.where(rng.random(n) < share, amount, 0.)
+
+
+def SyntheticPUF(records, seed=0):
+    """
+    Generates a synthetic PUF extract with the variables in
+    puf_cache.RECVARS.
+    """
+    rng = np.random.default_rng(seed)
+    puf = pd.DataFrame({
+        'e00200': np.round(_Income(rng, records, 0.75, 45000.)),
+        'e02100': np.round(_Income(rng, records, 0.02, 20000., 1.5)),
+        'e00900': np.round(_Income(rng, records, 0.15, 15000., 1.5)),
+        'e02000': np.round(_Income(rng, records, 0.1, 10000., 2.)),
+        'e00400': np.round(_Income(rng, records, 0.05, 3000., 1.5)),
+        'e00300': np.round(_Income(rng, records, 0.4, 1000., 1.5)),
+        'e00600': np.round(_Income(rng, records, 0.2, 3000., 2.)),
+        'e02300': np.round(_Income(rng, records, 0.05, 5000., 0.5)),
+        'e01500': np.round(_Income(rng, records, 0.2, 20000.)),
+        'e02400': np.round(_Income(rng, records, 0.2, 18000., 0.4)),
+        'age_head': rng.integers(18, 91, records),
+        's006': rng.uniform(50., 2500., records),
+        'RECID': np.arange(1, records + 1),
+        'MARS': rng.choice([1, 2, 3, 4, 5], records,
+                           p=[0.45, 0.4, 0.02, 0.12, 0.01])})
+    return puf
+
+
+def SyntheticSCF(households, seed=0):
+    """
+    Generates a synthetic SCF extract with the variables Y1, compincome,
+    activeincome, passiveincome, age, married and wgt, with 5 implicates for
+    each household.
+    """
+    rng = np.random.default_rng(seed)
+    active = np.round(_Income(rng, households, 0.8, 50000., 1.2), -2)
+    passive = np.round(_Income(rng, households, 0.6, 8000., 2.), -2)
+    age = rng.integers(18, 96, households)
+    wgt = rng.uniform(500., 5000., households)
+    # Repeat each household for the 5 implicates
+    yy1 = np.repeat(np.arange(1, households + 1), 5)
+    implicate = np.tile(np.arange(1, 6), households)
+    active = np.repeat(active, 5)
+    passive = np.repeat(passive, 5)
+    # Households whose income differs across implicates
+    vary = np.repeat(rng.random(households) >= SAME_SHARE, 5)
+    factor = rng.uniform(0.8, 1.2, len(yy1))
+    active = np.where(vary, np.round(active * factor, -2), active)
+    passive = np.where(vary, np.round(passive * factor, -2), passive)
+    scf = pd.DataFrame({'Y1': yy1 * 10 + implicate,
+                        'compincome': active + passive,
+                        'activeincome': active,
+                        'passiveincome': passive,
+                        'age': np.repeat(age, 5),
+                        'wgt': np.repeat(wgt, 5) * rng.uniform(0.9, 1.1,
+                                                               len(yy1))})
+    # Married or living with a partner (1) or neither (2)
+    scf['married'] = np.repeat(rng.choice([1, 2], households, p=[0.55, 0.45]),
+                               5)
+    return scf